@@ -1,8 +1,7 @@
 import os
-import json
 import asyncio
 from contextlib import asynccontextmanager
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
 
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
@@ -10,12 +9,16 @@ from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
+import json_codec
 from websocket_client import WebSocketClient
 
 API_BASE_URL = os.getenv("API_BASE_URL", "ws://ofa-api:8000")
+MAX_UPDATE_RATE = float(os.getenv("MAX_UPDATE_RATE", "5"))
+API_WIRE_FORMAT = os.getenv("API_WIRE_FORMAT", "json")
+API_COMPACT_KEYS = os.getenv("API_COMPACT_KEYS", "false").lower() == "true"
 templates = Jinja2Templates(directory="templates")
 
-ws_client = WebSocketClient(API_BASE_URL)
+ws_client = WebSocketClient(API_BASE_URL, MAX_UPDATE_RATE, API_WIRE_FORMAT, API_COMPACT_KEYS)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -33,7 +36,7 @@ app = FastAPI(
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-async def create_sse_stream() -> AsyncGenerator[str, None]:
+async def create_sse_stream() -> AsyncGenerator[bytes, None]:
     """
     Create Server-Sent Events stream.
     """
@@ -47,18 +50,18 @@ async def create_sse_stream() -> AsyncGenerator[str, None]:
                     ws_client.message_queue.get(), 
                     timeout=1.0
                 )
-                yield f"data: {json.dumps(message)}\n\n"
+                yield b"data: " + json_codec.dumps(message) + b"\n\n"
                 
             except asyncio.TimeoutError:
                 current_time = asyncio.get_event_loop().time()
                 if current_time - last_ping > ping_interval:
-                    yield f"data: {json.dumps({'event': 'ping'})}\n\n"
+                    yield b'data: {"event":"ping"}\n\n'
                     last_ping = current_time
             
         except Exception as e:
             print(f"Error in SSE stream: {e}")
             error_msg = {'event': 'error', 'message': str(e)}
-            yield f"data: {json.dumps(error_msg)}\n\n"
+            yield b"data: " + json_codec.dumps(error_msg) + b"\n\n"
             await asyncio.sleep(1)
 
 @app.get("/", response_class=HTMLResponse)
@@ -133,5 +136,15 @@ async def get_device(device_uuid: str):
         raise HTTPException(status_code=404, detail="Device not found")
     return {"device": device}
 
+@app.get("/api/devices/{device_uuid}/history")
+async def get_device_history(device_uuid: str, dataitems: Optional[str] = None,
+                             duration: float = 300, max_points: int = 0):
+    """Get recent samples of a device from the API history"""
+    if device_uuid not in ws_client.devices:
+        raise HTTPException(status_code=404, detail="Device not found")
+    dataitem_ids = dataitems.split(",") if dataitems else None
+    history = await ws_client.get_history(device_uuid, dataitem_ids, duration, max_points)
+    return {"device_uuid": device_uuid, "history": history}
+
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=3000, reload=True)
\ No newline at end of file
@@ -175,6 +175,36 @@ class Charts{
         });
 
         this.startRealTimeUpdates();
+        this.loadHistory();
+    }
+
+    async loadHistory() {
+        const missing = Object.keys(this.chartConfigs).filter(type => this.particleData[type].length === 0);
+        if (missing.length === 0) return;
+
+        try {
+            const params = new URLSearchParams({
+                dataitems: missing.join(','),
+                duration: this.TIME_WINDOW_MINUTES * 60,
+                max_points: this.MAX_DATA_POINTS
+            });
+            const response = await fetch(`/api/devices/DUSTTRAK/history?${params}`);
+            if (!response.ok) return;
+            const { history } = await response.json();
+
+            missing.forEach(particleType => {
+                const samples = history[particleType] || [];
+                if (samples.length === 0 || this.particleData[particleType].length > 0) return;
+                this.particleData[particleType] = samples.map(([timestamp, value]) => ({
+                    x: new Date(timestamp * 1000),
+                    y: this.convertToMicrogram(value)
+                }));
+                this.updateSingleAirQualityChart(particleType);
+            });
+            this.storage.saveParticleData(this.particleData);
+        } catch (error) {
+            console.warn('Failed to load air quality history:', error);
+        }
     }
 
     getChartOptions(timeRange) {
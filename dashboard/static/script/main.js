@@ -42,6 +42,10 @@ class Dashboard {
             this.handleDeviceUpdate(data);
         });
 
+        this.sseClient.on('enrichment', (data) => {
+            this.handleEnrichment(data);
+        });
+
         this.sseClient.on('connection_established', (data) => {
             this.handleConnectionEstablished(data);
         });
@@ -103,6 +107,23 @@ class Dashboard {
         this.updateConcentrationDisplay(dataitemId, processedValue);
     }
 
+    handleEnrichment(msg) {
+        const { data } = msg;
+        const { ID: dataitemId, durations, avg_value } = data;
+
+        if (durations) {
+            this.chartManager.updateDeviceChart(dataitemId, durations);
+        }
+
+        if (avg_value && Object.keys(avg_value).length > 0) {
+            this.chartManager.updateParticleConcentration(
+                dataitemId,
+                avg_value.value,
+                avg_value.timestamp
+            );
+        }
+    }
+
     handleConnectionEstablished(data) {
         const { device_uuid: deviceUuid, data_items: dataitems } = data;
         this.deviceManager.initializeDevice(deviceUuid, dataitems);
@@ -1,7 +1,18 @@
-import json
 import asyncio
 import websockets
-from typing import Dict, Any, Optional, Set
+from typing import Callable, Dict, Any, List, Optional, Set
+
+import json_codec
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
 
 
 
@@ -10,11 +21,21 @@ class WebSocketClient:
     WebSocket client for OpenFactory websockets API.
     """
     
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, max_update_rate: float = 0, wire_format: str = "json", compact_keys: bool = False):
         self.base_url = base_url
+        # Maximum updates per second requested from the API (0 for every sample)
+        self.max_update_rate = max_update_rate
+        self.wire_format = wire_format
+        self.compact_keys = compact_keys
+        # Last sequence number received per device and the API epoch they belong to, used to resume
+        self.last_seqs: Dict[str, int] = {}
+        self.epoch: Optional[str] = None
         self.devices: Dict[str, Dict[str, Any]] = {}
         self.message_queue = asyncio.Queue()
         self.device_tasks: Set[asyncio.Task] = set()
+        # One connection per API worker serving some of the devices, by URL
+        self.devices_by_url: Dict[str, List[str]] = {}
+        self._sockets: Dict[str, Any] = {}
         self.initialized = False
         
         self.max_retries = 5
@@ -61,7 +82,7 @@ class WebSocketClient:
         try:
             async with websockets.connect(f"{self.base_url}/ws/devices") as ws:
                 message = await ws.recv()
-                data = json.loads(message)
+                data = json_codec.loads(message)
                 
                 if data.get("event") == "devices_list":
                     for device in data.get("devices", []):
@@ -76,30 +97,50 @@ class WebSocketClient:
             print(f"Failed to fetch initial devices: {e}")
             
     async def _start_device_monitoring(self):
-        """Start monitoring tasks for all devices"""
-        for device_uuid in self.devices:
-            task = asyncio.create_task(
-                self._monitor_device(device_uuid),
-                name=f"monitor-{device_uuid}"
-            )
-            self.device_tasks.add(task)
-            
-            task.add_done_callback(self.device_tasks.discard)
+        """Start a single monitoring task for all devices"""
+        if not self.devices:
+            return
+        
+        url = f"{self.base_url}/ws/stream?format={self.wire_format}"
+        if self.compact_keys:
+            url += "&keys=compact"
+        if self.max_update_rate:
+            url += f"&max_rate={self.max_update_rate}"
+        
+        self.devices_by_url[url] = list(self.devices.keys())
+        self._start_monitoring(url)
+
+    def _start_monitoring(self, url: str):
+        """Start the monitoring task of the devices served at a URL"""
+        task = asyncio.create_task(
+            self._monitor_devices(url),
+            name=f"monitor-devices-{url}"
+        )
+        self.device_tasks.add(task)
+        
+        task.add_done_callback(self.device_tasks.discard)
 
-    async def _monitor_device(self, device_uuid: str):
-        """Monitor a single device with automatic reconnection"""
+    async def _monitor_devices(self, url: str):
+        """
+        Monitor the devices served at a URL over one connection with automatic reconnection,
+        giving up after max_retries consecutive failures
+        """
         retry_count = 0
+
+        def connected():
+            nonlocal retry_count
+            retry_count = 0
         
-        while retry_count < self.max_retries:
+        while retry_count < self.max_retries and self.devices_by_url.get(url):
             try:
-                await self._device_connection_loop(device_uuid)
+                await self._devices_connection_loop(url, connected)
                 break
                 
             except Exception as e:
                 retry_count += 1
                 
                 print(
-                    f"Device {device_uuid} connection failed (attempt {retry_count}): {e}"
+                    f"Devices stream connection failed (attempt {retry_count}): {e}"
                 )
                 
                 if retry_count < self.max_retries:
@@ -107,40 +148,142 @@ class WebSocketClient:
                         self.base_retry_delay * (2 ** (retry_count - 1)),
                         self.max_retry_delay
                     )
-                    print(f"Retrying {device_uuid} in {delay}s...")
+                    print(f"Retrying devices stream in {delay}s...")
                     await asyncio.sleep(delay)
                 else:
-                    print(f"Max retries reached for device {device_uuid}")
-
-    async def _device_connection_loop(self, device_uuid: str):
-        """Main connection loop for a device"""
-        async with websockets.connect(f"{self.base_url}/ws/devices/{device_uuid}") as ws:
-            print(f"Connected to device {device_uuid}")
-            while True:
-                try:
-                    data = await ws.recv()
-                    await self._handle_device_message(device_uuid, data)
-                    
-                except websockets.exceptions.ConnectionClosed:
-                    print(f"Connection closed for device {device_uuid}")
-                    break
-                    
-                except json.JSONDecodeError as e:
-                    print(f"JSON decode error for {device_uuid}: {e}")
-                    continue
+                    print("Max retries reached for devices stream")
+
+    async def _devices_connection_loop(self, url: str, on_connected: Callable[[], None]):
+        """Main connection loop for the multiplexed devices stream, calling on_connected once subscribed"""
+        async with websockets.connect(url) as ws:
+            key_names: Dict[str, str] = {}
+            devices = self.devices_by_url[url]
+            self._sockets[url] = ws
+            try:
+                await self._subscribe(ws, devices)
+                print(f"Connected to devices {devices}")
+                on_connected()
+                while True:
+                    try:
+                        data = await ws.recv()
+                        await self._handle_device_message(url, data, key_names)
+                        
+                    except json_codec.JSONDecodeError as e:
+                        print(f"JSON decode error for devices stream: {e}")
+                        continue
+            finally:
+                self._sockets.pop(url, None)
+
+    async def _subscribe(self, ws, devices: List[str]):
+        """Subscribe to devices, resuming from the last sequence numbers received"""
+        await ws.send(json_codec.dumps_str({
+            "method": "subscribe",
+            "params": {
+                "devices": devices,
+                "last_seq": {device: self.last_seqs[device] for device in devices if device in self.last_seqs},
+                "epoch": self.epoch
+            }
+        }))
+
+    async def _follow_redirect(self, url: str, message: Dict[str, Any]):
+        """Move devices served by another API worker to a connection with that worker"""
+        target_url = message["url"]
+        devices = message.get("devices", [])
+        print(f"Devices {devices} are served at {target_url}")
+        
+        self.devices_by_url[url] = [device for device in self.devices_by_url.get(url, []) if device not in devices]
+        target = self.devices_by_url.setdefault(target_url, [])
+        new_devices = [device for device in devices if device not in target]
+        target.extend(new_devices)
+        
+        if not any(task.get_name() == f"monitor-devices-{target_url}" for task in self.device_tasks):
+            self._start_monitoring(target_url)
+        elif target_url in self._sockets and new_devices:
+            await self._subscribe(self._sockets[target_url], new_devices)
 
-    async def _handle_device_message(self, device_uuid: str, raw_data: str):
-        """Process a message from a device"""
+    async def _handle_device_message(self, url: str, raw_data, key_names: Dict[str, str]):
+        """Process a message from the devices stream"""
         try:
-            parsed_data = json.loads(raw_data)
-            parsed_data["device_uuid"] = device_uuid
-            
-            self._update_device_data(device_uuid, parsed_data)
+            parsed_data = self._decode_frame(raw_data, key_names)
+            if parsed_data is None:
+                return
+            if parsed_data.get("event") == "redirect":
+                await self._follow_redirect(url, parsed_data)
+                return
+            messages = parsed_data["messages"] if parsed_data.get("event") == "batch" else [parsed_data]
             
-            await self.message_queue.put(parsed_data)
+            for message in messages:
+                if not self._track_sequence(message):
+                    continue
+                device_uuid = message.get("asset_uuid") or message.get("device_uuid")
+                message["device_uuid"] = device_uuid
+                self._update_device_data(device_uuid, message)
+                await self.message_queue.put(message)
             
         except Exception as e:
-            print(f"Error handling message from {device_uuid}: {e}")
+            print(f"Error handling message from devices stream: {e}")
+
+    def _decode_frame(self, frame, key_names: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """
+        Decode a frame in the negotiated format, returning None for the format announcement
+        (whose key dictionary is kept in key_names for the rest of the connection)
+        """
+        if isinstance(frame, str):
+            message = json_codec.loads(frame)
+        elif self.wire_format == "msgpack":
+            message = msgpack.unpackb(frame, raw=False)
+        elif self.wire_format == "cbor":
+            message = cbor2.loads(frame)
+        else:
+            message = json_codec.loads(frame)
+        
+        if message.get("event") == "format":
+            key_names.update({short: name for name, short in message.get("keys", {}).items()})
+            return None
+        if key_names:
+            message = self._expand_keys(message, key_names)
+        return message
+
+    def _track_sequence(self, message: Dict[str, Any]) -> bool:
+        """Record the sequence number of a message, returning False for one already received"""
+        event = message.get("event")
+        if event in ("subscribed", "connection_established"):
+            self.epoch = message.get("epoch", self.epoch)
+        elif event == "resumed" and message.get("reset"):
+            self.last_seqs.pop(message.get("device_uuid"), None)
+        
+        seq = message.get("seq")
+        device_uuid = message.get("asset_uuid")
+        if seq is None or device_uuid is None:
+            return True
+        if seq <= self.last_seqs.get(device_uuid, 0):
+            return False
+        self.last_seqs[device_uuid] = seq
+        return True
+
+    def _expand_keys(self, message: Dict[str, Any], key_names: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Restore the key names of a message sent with compact keys, which only renames the keys
+        of the message and of its data record
+        """
+        expanded = {}
+        for key, value in message.items():
+            name = key_names.get(key, key)
+            if name == "data" and isinstance(value, dict):
+                value = self._expand_record(value, key_names)
+            elif name == "messages" and isinstance(value, list):
+                value = [self._expand_keys(item, key_names) if isinstance(item, dict) else item for item in value]
+            expanded[name] = value
+        return expanded
+
+    def _expand_record(self, record: Dict[str, Any], key_names: Dict[str, str]) -> Dict[str, Any]:
+        expanded = {}
+        for key, value in record.items():
+            name = key_names.get(key, key)
+            if name == "avg_value" and isinstance(value, dict):
+                value = {key_names.get(k, k): v for k, v in value.items()}
+            expanded[name] = value
+        return expanded
 
     def _update_device_data(self, device_uuid: str, data: Dict[str, Any]):
         """Update device data from incoming message"""
@@ -191,9 +334,9 @@ class WebSocketClient:
                     }
                 }
                 
-                await ws.send(json.dumps(command))
+                await ws.send(json_codec.dumps_str(command))
                 response_data = await ws.recv()
-                response = json.loads(response_data)
+                response = json_codec.loads(response_data)
                 
                 print(f"Simulation mode {'enabled' if enabled else 'disabled'}")
                 return response
@@ -202,6 +345,38 @@ class WebSocketClient:
             print(f"Failed to send simulation mode to {device_uuid}: {e}")
             
 
+    async def get_history(self, device_uuid: str, dataitems: Optional[list] = None,
+                          duration: float = 300, max_points: int = 0) -> Dict[str, list]:
+        """Get the recent [timestamp, value] samples of a device's dataitems kept by the API"""
+        url = f"{self.base_url}/ws/stream"
+        try:
+            # At most one redirect, to the API worker serving the device
+            for _ in range(2):
+                async with websockets.connect(url) as ws:
+                    await ws.send(json_codec.dumps_str({
+                        "method": "history",
+                        "params": {
+                            "device_uuid": device_uuid,
+                            "dataitems": dataitems,
+                            "duration": duration,
+                            "max_points": max_points
+                        }
+                    }))
+                    while True:
+                        response = json_codec.loads(await asyncio.wait_for(ws.recv(), timeout=10))
+                        if response.get("event") == "history":
+                            return response.get("dataitems", {})
+                        if response.get("event") == "redirect":
+                            url = response["url"]
+                            break
+                        if response.get("event") == "error":
+                            raise ValueError(response.get("message"))
+            return {}
+                
+        except Exception as e:
+            print(f"Failed to get history for {device_uuid}: {e}")
+            return {}
+
     def get_device(self, device_uuid: str) -> Optional[Dict[str, Any]]:
         """Get a specific device"""
         return self.devices.get(device_uuid)
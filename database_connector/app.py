@@ -12,7 +12,11 @@ class DatabaseConnectorApp:
         file_path = os.path.join(curr_dir, 'config.json')
         with open(file_path, 'r', encoding='utf-8') as file:
             config_data = json.load(file)
-        self.websocket_client = OpenFactoryWebSocketClient(config_data["base_url"] if config_data else "")
+        self.websocket_client = OpenFactoryWebSocketClient(
+            config_data["base_url"] if config_data else "",
+            config_data.get("wire_format", "json") if config_data else "json",
+            config_data.get("compact_keys", False) if config_data else False
+        )
         self.db_manager = DatabaseManager()
     
     async def run(self):
@@ -25,7 +29,7 @@ class DatabaseConnectorApp:
 
             self.assets = self.db_manager.fetch_all_assets()
             
-            await self.websocket_client.start(self.assets)
+            await self.websocket_client.start(self.assets, self.db_manager.fetch_linked_dataitems())
         except KeyboardInterrupt:
             print("\nShutting down app...")
             await self.websocket_client.stop()
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Dict, List
 import pyodbc
 import os
 import time
@@ -125,6 +125,20 @@ class DatabaseManager:
             print(f"Error fetching assets: {e}")
             return []
         
+    def fetch_linked_dataitems(self) -> Dict[str, List[str]]:
+        """Fetch the DataitemIds linked to a variable, by AssetUuid"""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT DISTINCT AssetUuid, DataitemId FROM OpenFactoryLink")
+            dataitems = {}
+            for asset_uuid, dataitem_id in cursor:
+                dataitems.setdefault(asset_uuid, []).append(dataitem_id)
+            cursor.close()
+            return dataitems
+        except Exception as e:
+            print(f"Error fetching linked dataitems: {e}")
+            return {}
+
     def fetch_assets(self, included_assets:List[str]=[], excluded_assets:List[str]=[]):
         pass
     
@@ -0,0 +1,46 @@
+"""
+JSON decoding of the database connector, with orjson when it is installed and the standard
+json module otherwise.
+
+The API, the dashboard and the database connector each have a copy of this module, as
+their images are built from their own directories: a fix to one applies to all three.
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Raised by loads() for invalid JSON, whichever library decodes it
+JSONDecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode to compact UTF-8 JSON"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=_ORJSON_OPTIONS)
+        except TypeError:
+            # Types orjson refuses (integers over 64 bits, ...) are left to the json module
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def dumps_str(obj: Any) -> str:
+    return dumps(obj).decode('utf-8')
+
+
+def loads(data: Union[bytes, bytearray, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def library() -> str:
+    """Name of the library in use"""
+    return 'orjson' if orjson is not None else 'json'
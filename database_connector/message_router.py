@@ -1,7 +1,7 @@
 from typing import Any, Dict, Optional
 from dataclasses import dataclass
 from datetime import datetime
-import json
+import json_codec
 
 @dataclass
 class DeviceMessage:
@@ -20,12 +20,12 @@ class MessageRouter:
         self.db_manager = db_manager
         self.subscribed_devices: Dict[str, Dict] = {}
     
-    def handle_message(self, raw_message: str):
+    def handle_message(self, raw_message):
         """
         Main message handler - routes incoming WebSocket messages to appropriate actions
         """
         try:
-            message_data = json.loads(raw_message)
+            message_data = json_codec.loads(raw_message) if isinstance(raw_message, (str, bytes)) else raw_message
             if(message_data.get('event', False)):
                 return
             device_message = self.parse_device_message(message_data)
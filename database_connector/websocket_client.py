@@ -1,82 +1,216 @@
 import asyncio
 import os
 import websockets
-from typing import Dict, Callable, List, Optional
+from typing import Any, Dict, Callable, List, Optional
+
+import json_codec
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
 
 class OpenFactoryWebSocketClient:
     """WebSocket client for OpenFactory to connect and interact with devices."""
-    
-    def __init__(self, base_url: str = "ws://ofa-api:8000"):
-        """Initialize the WebSocket client with the base URL."""
+
+    def __init__(self, base_url: str = "ws://ofa-api:8000", wire_format: str = "json", compact_keys: bool = False):
+        """Initialize the WebSocket client with the base URL and the wire format to negotiate."""
         self.base_url = base_url
+        self.wire_format = wire_format
+        self.compact_keys = compact_keys
+        # Last sequence number received per asset and the API epoch they belong to, used to resume
+        self.last_seqs: Dict[str, int] = {}
+        self.epoch: Optional[str] = None
+        self.assets: List[str] = []
+        # Dataitems to receive by asset, all of them for assets not listed
+        self.dataitems: Dict[str, List[str]] = {}
+        # One connection per API worker serving some of the assets, by URL
+        self.assets_by_url: Dict[str, List[str]] = {}
         self.connection_tasks: Dict[str, asyncio.Task] = {}
+        self._sockets: Dict[str, Any] = {}
         self.message_handler: Optional[Callable] = None
         self.running = False
-        
+
     def set_message_handler(self, handler: Callable):
         """Set the message handler function"""
         self.message_handler = handler
 
-    async def start(self, assets: List[str]):
-        """Start the WebSocket client and begin listening for messages"""
+    async def start(self, assets: List[str], dataitems: Optional[Dict[str, List[str]]] = None):
+        """Start the WebSocket client and begin listening for messages, only the given dataitems of each asset if any"""
         self.running = True
-        
+        self.assets = list(assets)
+        self.dataitems = dict(dataitems or {})
+
         print(f"Starting WebSocket client with assets: {assets}")
-        
-        for asset_uuid in assets:
-            if asset_uuid not in self.connection_tasks:
-                print(f"Creating connection task for asset: {asset_uuid}")
-                task = asyncio.create_task(self._maintain_connection(asset_uuid))
-                self.connection_tasks[asset_uuid] = task
-        
-        if self.connection_tasks:
-            await asyncio.gather(*self.connection_tasks.values(), return_exceptions=True)
-
-    async def _maintain_connection(self, device_uuid: str):
-        """Maintain a persistent connection to a device's WebSocket"""
+
+        stream_ws_url = f"{self.base_url}/ws/stream?format={self.wire_format}"
+        if self.compact_keys:
+            stream_ws_url += "&keys=compact"
+
+        if self.assets and stream_ws_url not in self.connection_tasks:
+            self.assets_by_url[stream_ws_url] = list(self.assets)
+            self.connection_tasks[stream_ws_url] = asyncio.create_task(self._maintain_connection(stream_ws_url))
+
+        # Connections to other workers may be added while waiting
         while self.running:
+            pending = [task for task in self.connection_tasks.values() if not task.done()]
+            if not pending:
+                break
+            await asyncio.wait(pending)
+
+    async def _maintain_connection(self, stream_ws_url: str):
+        """Maintain a persistent multiplexed connection for the assets served at a URL"""
+        while self.running and self.assets_by_url.get(stream_ws_url):
             try:
-                await self._listen_for_messages(device_uuid)
+                await self._listen_for_messages(stream_ws_url)
             except Exception as e:
-                print(f"Connection error for device {device_uuid}: {e}")
+                print(f"Connection error for assets stream: {e}")
                 print("Retrying connection in 5 seconds...")
                 await asyncio.sleep(5)
 
-    async def _listen_for_messages(self, device_uuid: str):
-        """Subscribe to a device's WebSocket stream and listen for messages"""
-        device_ws_url = f"{self.base_url}/ws/devices/{device_uuid}"
-        
-        print(f"Attempting to connect to: {device_ws_url}")
-        
+    async def _listen_for_messages(self, stream_ws_url: str):
+        """Subscribe to the assets served at a URL over a single WebSocket and listen for messages"""
+        print(f"Attempting to connect to: {stream_ws_url}")
+
         try:
-            async with websockets.connect(device_ws_url) as ws:
-                print(f"Successfully connected to WebSocket for device {device_uuid}")
-                
+            async with websockets.connect(stream_ws_url) as ws:
+                key_names: Dict[str, str] = {}
+                assets = self.assets_by_url[stream_ws_url]
+                self._sockets[stream_ws_url] = ws
+                await self._subscribe(ws, assets)
+                print(f"Successfully connected to WebSocket for assets {assets}")
+
                 while self.running:
                     try:
-                        msg = await ws.recv()
-                        self.message_handler(msg)
+                        msg = self._decode_frame(await ws.recv(), key_names)
+                        if msg is None:
+                            continue
+                        if msg.get("event") == "redirect":
+                            await self._follow_redirect(stream_ws_url, msg)
+                        elif self._track_sequence(msg):
+                            self.message_handler(msg)
                     except websockets.exceptions.ConnectionClosed as e:
-                        print(f"WebSocket connection closed for {device_uuid}: {e}")
+                        print(f"WebSocket connection closed for assets stream: {e}")
                         break
-                        
+
         except websockets.exceptions.InvalidURI as e:
-            print(f"Invalid WebSocket URI for {device_uuid}: {e}")
-            print(f"Attempted URL: {device_ws_url}")
+            print(f"Invalid WebSocket URI: {e}")
+            print(f"Attempted URL: {stream_ws_url}")
             raise
         except asyncio.TimeoutError:
-            print(f"Connection timeout for {device_uuid}")
+            print("Connection timeout for assets stream")
             raise
         except Exception as e:
-            print(f"Unexpected error connecting to {device_uuid}: {type(e).__name__}: {e}")
+            print(f"Unexpected error connecting to assets stream: {type(e).__name__}: {e}")
             raise
+        finally:
+            self._sockets.pop(stream_ws_url, None)
+
+    async def _subscribe(self, ws, assets: List[str]):
+        """Subscribe to assets, resuming from the last sequence numbers received"""
+        await ws.send(json_codec.dumps_str({
+            "method": "subscribe",
+            "params": {
+                "devices": assets,
+                "last_seq": {asset: self.last_seqs[asset] for asset in assets if asset in self.last_seqs},
+                "epoch": self.epoch,
+                "include": {asset: self.dataitems[asset] for asset in assets if asset in self.dataitems}
+            }
+        }))
+
+    async def _follow_redirect(self, stream_ws_url: str, msg: Dict[str, Any]):
+        """Move assets served by another API worker to a connection with that worker"""
+        url = msg["url"]
+        devices = msg.get("devices", [])
+        print(f"Assets {devices} are served at {url}")
+
+        current = self.assets_by_url.get(stream_ws_url, [])
+        self.assets_by_url[stream_ws_url] = [asset for asset in current if asset not in devices]
+        target = self.assets_by_url.setdefault(url, [])
+        new_devices = [device for device in devices if device not in target]
+        target.extend(new_devices)
+
+        task = self.connection_tasks.get(url)
+        if task is None or task.done():
+            self.connection_tasks[url] = asyncio.create_task(self._maintain_connection(url))
+        elif url in self._sockets and new_devices:
+            await self._subscribe(self._sockets[url], new_devices)
+
+    def _decode_frame(self, frame, key_names: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """
+        Decode a frame in the negotiated format, returning None for the format announcement
+        (whose key dictionary is kept in key_names for the rest of the connection)
+        """
+        if isinstance(frame, str):
+            message = json_codec.loads(frame)
+        elif self.wire_format == "msgpack":
+            message = msgpack.unpackb(frame, raw=False)
+        elif self.wire_format == "cbor":
+            message = cbor2.loads(frame)
+        else:
+            message = json_codec.loads(frame)
+
+        if message.get("event") == "format":
+            key_names.update({short: name for name, short in message.get("keys", {}).items()})
+            return None
+        if key_names:
+            message = self._expand_keys(message, key_names)
+        return message
+
+    def _track_sequence(self, msg: Dict[str, Any]) -> bool:
+        """Record the sequence number of a message, returning False for one already received"""
+        event = msg.get("event")
+        if event in ("subscribed", "connection_established"):
+            self.epoch = msg.get("epoch", self.epoch)
+        elif event == "resumed":
+            if msg.get("reset"):
+                self.last_seqs.pop(msg.get("device_uuid"), None)
+            if not msg.get("complete", True):
+                print(f"Messages for {msg.get('device_uuid')} after seq {msg.get('from_seq')} could not all be replayed")
+
+        seq = msg.get("seq")
+        asset_uuid = msg.get("asset_uuid")
+        if seq is None or asset_uuid is None:
+            return True
+        if seq <= self.last_seqs.get(asset_uuid, 0):
+            return False
+        self.last_seqs[asset_uuid] = seq
+        return True
+
+    def _expand_keys(self, message: Dict[str, Any], key_names: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Restore the key names of a message sent with compact keys, which only renames the keys
+        of the message and of its data record
+        """
+        expanded = {}
+        for key, value in message.items():
+            name = key_names.get(key, key)
+            if name == "data" and isinstance(value, dict):
+                value = self._expand_record(value, key_names)
+            elif name == "messages" and isinstance(value, list):
+                value = [self._expand_keys(item, key_names) if isinstance(item, dict) else item for item in value]
+            expanded[name] = value
+        return expanded
+
+    def _expand_record(self, record: Dict[str, Any], key_names: Dict[str, str]) -> Dict[str, Any]:
+        expanded = {}
+        for key, value in record.items():
+            name = key_names.get(key, key)
+            if name == "avg_value" and isinstance(value, dict):
+                value = {key_names.get(k, k): v for k, v in value.items()}
+            expanded[name] = value
+        return expanded
 
     async def stop(self):
         """Stop the WebSocket client"""
         self.running = False
-        
-        for task in self.connection_tasks.values():
+
+        tasks = list(self.connection_tasks.values())
+        for task in tasks:
             task.cancel()
-            
-        if self.connection_tasks:
-            await asyncio.gather(*self.connection_tasks.values(), return_exceptions=True)
\ No newline at end of file
+        await asyncio.gather(*tasks, return_exceptions=True)
\ No newline at end of file
@@ -1,47 +1,111 @@
 import asyncio
+import multiprocessing
 import threading
 import time
 import websockets
+from functools import partial
+from typing import Callable
+from urllib.parse import urlsplit
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 from openfactory.apps import OpenFactoryApp
 from openfactory.assets import Asset
 from openfactory.kafka import KSQLDBClient
 
 from config import Config
+from exceptions import StreamCreationException
+from metrics import metrics_response, register_connection_manager
+from services.async_ksqldb import AsyncKSQLDBClient
 from services.device_service import DeviceService
 from services.stream_service import StreamService
 from connection.connection_manager import ConnectionManager
+from connection.replay_buffer import ReplayBuffer
 from connection.websockets_manager import WebsocketsManager
+from connection.wire_format import WireFormat
+from connection.worker_router import WorkerRouter
 from topic_subscription import TopicSubscriber
 
 class OpenFactoryAPI(OpenFactoryApp):
-    """Main application class that orchestrates all components"""
+    """
+    Main application class that orchestrates all components.
 
-    def __init__(self, config: Config, app_uuid, ksqlClient, bootstrap_servers, loglevel='INFO'):
+    The Kafka topic subscriber and the device Assets are built by topic_subscriber_factory
+    and asset_factory, which take the arguments of TopicSubscriber and Asset, so they can
+    be replaced by stand-ins (see benchmarks/load_test.py).
+    """
+
+    def __init__(self, config: Config, app_uuid, ksqlClient, bootstrap_servers, loglevel='INFO',
+                 worker_index: int = 0, replay_epoch: str = None,
+                 topic_subscriber_factory: Callable[..., TopicSubscriber] = TopicSubscriber,
+                 asset_factory: Callable[..., Asset] = Asset):
         super().__init__(app_uuid, ksqlClient, bootstrap_servers, loglevel)
         object.__setattr__(self, 'ASSET_ID', 'IVAC')
         self.running = True
         self.config = config
 
         self.ksqlClient = ksqlClient
-        self.connection_manager = ConnectionManager()
+        self.asset_factory = asset_factory
+        self.async_ksql = AsyncKSQLDBClient(ksqlClient, config.ksqldb_max_workers, config.ksqldb_timeout)
+        self.worker_router = WorkerRouter(
+            config.workers,
+            worker_index,
+            config.shared_stream_partitions,
+            config.websocket_port,
+            config.worker_host
+        )
+        kafka_group_id = config.kafka_group_id
+        if self.worker_router.enabled:
+            kafka_group_id = f"{config.kafka_group_id}_{worker_index}"
+        self.topic_subscriber = topic_subscriber_factory(
+            config.kafka_brokers,
+            kafka_group_id,
+            max_records=config.kafka_max_records,
+            linger_ms=config.kafka_linger_ms
+        )
+        if self.worker_router.enabled and config.stream_mode == StreamService.SHARED:
+            self.topic_subscriber.assign_partitions(config.shared_stream_topic, self.worker_router.owned_partitions())
+        self.connection_manager = ConnectionManager(
+            config.max_queue_size, config.overflow_policy, config.replay_buffer_size, replay_epoch
+        )
+        register_connection_manager(self.connection_manager)
+        self.stream_service = StreamService(
+            self.async_ksql,
+            config.stream_mode,
+            config.shared_stream_topic,
+            config.shared_stream_partitions
+        )
         self.websockets_manager = WebsocketsManager(
             self.connection_manager,
-            DeviceService(self.ksqlClient), 
-            StreamService(self.ksqlClient),
+            DeviceService(
+                self.async_ksql, config.device_cache_ttl, config.moving_average_windows,
+                config.history_max_samples, config.history_max_age,
+                power_durations_refresh=0 if self.worker_router.owns('IVAC') else config.device_cache_ttl
+            ),
+            self.stream_service,
             self.topic_subscriber,
-            self
+            self,
+            self.worker_router,
+            config.heartbeat_interval,
+            config.device_idle_ttl,
+            config.enrichment_concurrency
         )
         
-        self.websocket_server = None
+        self.websocket_servers = []
         self.websocket_task = None
         self.websocket_thread = None
 
-    def initialize_asset(self, device_uuid: str):
-        return Asset(
+    async def initialize_asset(self, device_uuid: str):
+        """Create a device's Asset in the ksqlDB pool, as it queries ksqlDB and connects to Kafka"""
+        return await self.async_ksql.run(partial(
+            self.asset_factory,
             device_uuid,
             ksqlClient=self.ksqlClient,
             bootstrap_servers=self.config.kafka_brokers
-        )
+        ))
+
+    async def close_asset(self, asset):
+        """Close a device's Asset in the ksqlDB pool, releasing its Kafka and ksqlDB resources"""
+        if asset is not None:
+            await self.async_ksql.run(asset.close)
     
     def send_method(self, name, args):
         self.method(name, args)
@@ -64,9 +128,13 @@ class OpenFactoryAPI(OpenFactoryApp):
                     len(connections) for connections in self.connection_manager.device_connections.values()
                 )
                 if total_connections > 0:
+                    queue_stats = self.connection_manager.get_queue_stats()
+                    worker = f"[worker {self.worker_router.index}] " if self.worker_router.enabled else ""
                     print(
-                        f"Active WebSocket connections: {total_connections} "
-                        f"across {len(self.connection_manager.device_connections)} devices"
+                        f"{worker}Active WebSocket connections: {total_connections} "
+                        f"across {len(self.connection_manager.device_connections)} devices "
+                        f"(pending: {queue_stats['pending']}, dropped: {queue_stats['dropped']}, "
+                        f"conflated: {queue_stats['conflated']}, disconnected: {queue_stats['disconnected']})"
                     )
                 time.sleep(30)
             except KeyboardInterrupt:
@@ -92,14 +160,31 @@ class OpenFactoryAPI(OpenFactoryApp):
     async def _start_websocket_server(self):
         """Start the actual WebSocket server (async)"""
         try:
-            self.websocket_server = await websockets.serve(
-                self.websockets_manager.handle_connection,
-                self.config.websocket_host,
-                self.config.websocket_port,
-                ping_interval=self.config.ping_interval,
-                ping_timeout=self.config.ping_timeout
-            )
-            print(f"WebSocket server started on {self.config.websocket_host}:{self.config.websocket_port}")
+            if self.config.stream_mode == StreamService.SHARED:
+                try:
+                    await self.stream_service.create_shared_stream()
+                except StreamCreationException as e:
+                    print(f"Shared stream will be created on first connection: {e}")
+
+            # Workers share the main port, and each also listens on its own for redirected clients
+            ports = [self.config.websocket_port]
+            if self.worker_router.enabled:
+                ports.append(self.worker_router.port)
+            for port in ports:
+                self.websocket_servers.append(await websockets.serve(
+                    self.websockets_manager.handle_connection,
+                    self.config.websocket_host,
+                    port,
+                    ping_interval=self.config.ping_interval,
+                    ping_timeout=self.config.ping_timeout,
+                    subprotocols=WireFormat.available_subprotocols(),
+                    select_subprotocol=WireFormat.select_subprotocol,
+                    compression=None,
+                    extensions=self._compression_extensions(),
+                    process_request=self._process_request,
+                    reuse_port=self.worker_router.enabled and port == self.config.websocket_port
+                ))
+                print(f"WebSocket server started on {self.config.websocket_host}:{port}")
             
             while self.running:
                 await asyncio.sleep(1)
@@ -108,9 +193,30 @@ class OpenFactoryAPI(OpenFactoryApp):
             print(f"WebSocket server error: {e}")
             self.running = False
         finally:
-            if self.websocket_server:
-                self.websocket_server.close()
-                await self.websocket_server.wait_closed()
+            for websocket_server in self.websocket_servers:
+                websocket_server.close()
+                await websocket_server.wait_closed()
+            await self.websockets_manager.stop()
+
+    def _process_request(self, connection, request):
+        """Serve /metrics over HTTP and route other requests to the owning worker"""
+        if urlsplit(request.path).path == "/metrics":
+            return metrics_response(connection)
+        return self.worker_router.process_request(connection, request)
+
+    def _compression_extensions(self) -> list:
+        """Build the permessage-deflate extension from the compression settings"""
+        if self.config.compression != "deflate":
+            return []
+        return [
+            ServerPerMessageDeflateFactory(
+                server_max_window_bits=self.config.compression_window_bits,
+                compress_settings={
+                    "level": self.config.compression_level,
+                    "memLevel": self.config.compression_mem_level
+                }
+            )
+        ]
 
     def app_event_loop_stopped(self):
         """
@@ -118,17 +224,27 @@ class OpenFactoryAPI(OpenFactoryApp):
         """
         print("OpenFactory app event loop stopped, cleaning up...")
         self.running = False
+        self.topic_subscriber.stop_all_kafka_subscriptions()
+        self.async_ksql.shutdown()
 
 
-def main():
-    """Main entry point"""
-    config = Config()
-    
+def worker_app_uuid(worker_index: int) -> str:
+    """
+    OpenFactory app identity of a worker: each worker is an app of its own, with its own
+    commands and availability, worker 0 keeping the OFA-API UUID of apps.yml
+    """
+    return 'OFA-API' if worker_index == 0 else f'OFA-API-{worker_index}'
+
+
+def run_worker(config: Config, worker_index: int = 0, replay_epoch: str = None):
+    """Run one API process"""
     api = OpenFactoryAPI(
-        app_uuid='OFA-API',
+        app_uuid=worker_app_uuid(worker_index),
         config=config,
         ksqlClient=KSQLDBClient(config.ksqldb_url),
-        bootstrap_servers=config.kafka_brokers
+        bootstrap_servers=config.kafka_brokers,
+        worker_index=worker_index,
+        replay_epoch=replay_epoch
     )
     
     try:
@@ -138,5 +254,54 @@ def main():
     finally:
         api.running = False
 
+
+def run_workers(config: Config):
+    """Run config.workers API processes sharing the websocket port, each owning a set of devices"""
+    if config.stream_mode == StreamService.SHARED:
+        if config.shared_stream_partitions < config.workers:
+            print(f"Only {config.shared_stream_partitions} of the {config.workers} workers will own devices, "
+                  f"increase shared_stream_partitions")
+        # Created once here so workers never race to create it
+        ksql = AsyncKSQLDBClient(KSQLDBClient(config.ksqldb_url), 1, config.ksqldb_timeout)
+        try:
+            asyncio.run(StreamService(
+                ksql,
+                config.stream_mode,
+                config.shared_stream_topic,
+                config.shared_stream_partitions
+            ).create_shared_stream())
+        except StreamCreationException as e:
+            print(f"Shared stream will be created by the workers: {e}")
+        finally:
+            ksql.shutdown()
+
+    replay_epoch = ReplayBuffer.new_epoch()
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_worker, args=(config, index, replay_epoch), name=f"ofa-api-worker-{index}")
+        for index in range(config.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        print("Received shutdown signal, stopping workers")
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+def main():
+    """Main entry point"""
+    config = Config()
+    
+    if config.workers > 1:
+        run_workers(config)
+    else:
+        run_worker(config)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
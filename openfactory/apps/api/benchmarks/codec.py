@@ -0,0 +1,155 @@
+"""
+Micro-benchmark of json_codec against the standard json module on the messages of the
+IVAC, DUSTTRAK and WTVB01 devices, at each hop: decoding the Kafka record, encoding the
+websocket frame and decoding it in a client. stream_frame is the frame of a stream message
+built from a copy of its decoded record, against the API's encoding of it (splicing the
+record as received with the json module). Run from openfactory/apps/api:
+
+    python -m benchmarks.codec --output codec_results.json
+"""
+import argparse
+import json
+import math
+import platform
+import time
+import timeit
+from datetime import datetime, timezone
+
+import json_codec
+from connection.wire_format import OutboundMessage, WireFormat
+
+TIMESTAMP = "2025-06-12T14:03:27.123456000"
+
+
+def spectrogram_record() -> dict:
+    """A WTVB01 spectrogram as computed by its monitoring app: 20 s at 100 Hz, 48 sample windows"""
+    frequencies = [index * 100.0 / 48 for index in range(25)]
+    times = [index * 0.24 for index in range(84)]
+    return {
+        "ID": "spectrogram",
+        "spectrogram": [[abs(math.sin(f * 0.37 + t * 1.3)) * 1e-3 for t in times] for f in frequencies],
+        "spectrogram_shape": [len(frequencies), len(times)],
+        "frequencies": frequencies,
+        "times": times,
+        "sampling_rate": 100.0,
+        "window_size": 48,
+        "hop_length": 24,
+        "TIMESTAMP": TIMESTAMP
+    }
+
+
+RECORDS = {
+    "IVAC": {"ID": "A2ToolPlus", "VALUE": "ON", "TIMESTAMP": TIMESTAMP},
+    "DUSTTRAK": {"ID": "pm2_5_concentration", "VALUE": "0.0153", "TIMESTAMP": TIMESTAMP},
+    "WTVB01": spectrogram_record(),
+}
+
+# Values the API derives from the records, sent in enrichment events
+ENRICHMENTS = {
+    "IVAC": {"durations": {"ON": 18234, "OFF": 90211, "UNAVAILABLE": 312}},
+    "DUSTTRAK": {"avg_value": {"value": 0.014825, "timestamp": TIMESTAMP}},
+    "WTVB01": {},
+}
+
+# Frames of clients limited to a maximum rate carry several messages
+BATCH_SIZE = 20
+
+
+def outbound_message(device_uuid: str, seq: int = 1) -> dict:
+    return {
+        "asset_uuid": device_uuid,
+        "data": {**RECORDS[device_uuid], **ENRICHMENTS[device_uuid]},
+        "timestamp": time.time(),
+        "seq": seq
+    }
+
+
+def stdlib_operations(device_uuid: str) -> dict:
+    """The hops as they were done with the json module"""
+    record = json.dumps(RECORDS[device_uuid]).encode('utf-8')
+    message = outbound_message(device_uuid)
+    batch = {"event": "batch", "messages": [outbound_message(device_uuid, seq) for seq in range(BATCH_SIZE)]}
+    frame = json.dumps(message)
+    decoded = json.loads(record)
+    return {
+        "kafka_decode": lambda: json.loads(record.decode('utf-8')),
+        "stream_frame": lambda: json.dumps(
+            {"asset_uuid": device_uuid, "data": dict(decoded), "timestamp": time.time(), "seq": 1}
+        ),
+        "encode": lambda: json.dumps(message),
+        "encode_batch": lambda: json.dumps(batch),
+        "client_decode": lambda: json.loads(frame),
+    }
+
+
+def codec_operations(device_uuid: str) -> dict:
+    record = json_codec.dumps(RECORDS[device_uuid])
+    message = outbound_message(device_uuid)
+    batch = {"event": "batch", "messages": [outbound_message(device_uuid, seq) for seq in range(BATCH_SIZE)]}
+    frame = json_codec.dumps(message)
+    decoded = json_codec.loads(record)
+    wire_format = WireFormat()
+    return {
+        "kafka_decode": lambda: json_codec.loads(record),
+        "stream_frame": lambda: OutboundMessage(
+            {"asset_uuid": device_uuid, "data": decoded, "timestamp": time.time(), "seq": 1}, raw_data=record
+        ).encode(wire_format),
+        "encode": lambda: json_codec.dumps(message),
+        "encode_batch": lambda: json_codec.dumps(batch),
+        "client_decode": lambda: json_codec.loads(frame),
+    }
+
+
+def microseconds(operation, number: int, repeat: int) -> float:
+    """Best time of an operation over several runs, in microseconds"""
+    timer = timeit.Timer(operation)
+    if not number:
+        number, _ = timer.autorange()
+    return min(timer.repeat(number=number, repeat=repeat)) / number * 1e6
+
+
+def run(args) -> dict:
+    results = {}
+    for device_uuid in RECORDS:
+        stdlib = stdlib_operations(device_uuid)
+        codec = codec_operations(device_uuid)
+        results[device_uuid] = {}
+        for name in stdlib:
+            stdlib_us = microseconds(stdlib[name], args.number, args.repeat)
+            codec_us = microseconds(codec[name], args.number, args.repeat)
+            results[device_uuid][name] = {
+                "json_us": round(stdlib_us, 3),
+                "json_codec_us": round(codec_us, 3),
+                "speedup": round(stdlib_us / codec_us, 2),
+            }
+    return {
+        "benchmark": "json_codec",
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "library": json_codec.library(),
+        "parameters": vars(args),
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the JSON codec on OpenFactory messages")
+    parser.add_argument("--number", type=int, default=0,
+                        help="Calls per timing run (0 for enough calls to last 0.2 s)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing runs, the best one is kept")
+    parser.add_argument("--output", default="-", help="JSON results file ('-' for stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    if args.output == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+import json_codec
+from services.timestamps import STREAM_TIMEZONE, format_stream_timestamp
+
+
+class FakeKSQLDBClient:
+    """
+    In-process stand-in for KSQLDBClient answering the queries of the API from a fixed set
+    of devices, each with the same dataitems. Every call can be delayed to model the
+    round trip to ksqlDB.
+    """
+
+    def __init__(self, devices: List[str], dataitems: List[str], latency: float = 0.0):
+        self.devices = devices
+        self.dataitems = dataitems
+        self.latency = latency
+        self.queries = 0
+        self.statements = 0
+
+    def query(self, query: str) -> pd.DataFrame:
+        self.queries += 1
+        self._wait()
+        if "FROM assets_type" in query:
+            return pd.DataFrame({"ASSET_UUID": [f"{device}-Agent" for device in self.devices]})
+
+        if "FROM assets " in query:
+            match = re.search(r"ASSET_UUID = '([^']*)'", query)
+            if match:
+                devices = [match.group(1)] if match.group(1) in self.devices else []
+                return pd.DataFrame({
+                    "ID": [dataitem for _ in devices for dataitem in self.dataitems],
+                    "VALUE": ["0" for _ in devices for _ in self.dataitems],
+                })
+            return pd.DataFrame({
+                "ASSET_UUID": [device for device in self.devices for _ in self.dataitems],
+                "ID": [dataitem for _ in self.devices for dataitem in self.dataitems],
+                "VALUE": ["0" for _ in self.devices for _ in self.dataitems],
+            })
+
+        return pd.DataFrame()
+
+    def statement_query(self, statement: str):
+        self.statements += 1
+        self._wait()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeTopicSubscriber:
+    """
+    In-process stand-in for TopicSubscriber. Records published with publish() are
+    dispatched from the publishing thread, like the consumer thread of TopicSubscriber
+    dispatches the records of a poll.
+    """
+
+    def __init__(self):
+        self._handlers: Dict[str, Dict[Optional[str], Tuple[Callable, bool, bool]]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe_to_kafka_topic(self, topic: str, on_message: Callable, key: Optional[str] = None,
+                                 batch: bool = False, raw: bool = False) -> None:
+        with self._lock:
+            handlers = {**self._handlers.get(topic, {}), key: (on_message, batch, raw)}
+            self._handlers = {**self._handlers, topic: handlers}
+
+    def assign_partitions(self, topic: str, partitions) -> None:
+        pass
+
+    def unsubscribe_from_kafka_topic(self, topic: str, key: Optional[str] = None) -> None:
+        with self._lock:
+            handlers = {k: v for k, v in self._handlers.get(topic, {}).items() if k != key}
+            if handlers:
+                self._handlers = {**self._handlers, topic: handlers}
+            else:
+                self._handlers = {t: h for t, h in self._handlers.items() if t != topic}
+
+    def stop_kafka_topic_subscription(self, topic: str) -> None:
+        with self._lock:
+            self._handlers = {t: h for t, h in self._handlers.items() if t != topic}
+
+    def stop_all_kafka_subscriptions(self) -> None:
+        with self._lock:
+            self._handlers = {}
+
+    def get_active_kafka_subscriptions(self) -> list:
+        return list(self._handlers.keys())
+
+    def publish(self, records: List[Tuple[str, bytes]]) -> int:
+        """
+        Decode and dispatch JSON records keyed by device UUID to the callbacks registered for
+        their device, whichever topic (device or shared stream) they were registered on.
+        Returns the number of records nobody subscribed to.
+        """
+        undelivered = 0
+        batches: Dict[Callable, list] = {}
+        for key, raw_value in records:
+            value = json_codec.loads(raw_value)
+            dispatched = False
+            for handlers in self._handlers.values():
+                handler = handlers.get(key)
+                if handler is None:
+                    continue
+                on_message, batch, raw = handler
+                record = (key, value, raw_value) if raw else (key, value)
+                if batch:
+                    batches.setdefault(on_message, []).append(record)
+                else:
+                    on_message(*record)
+                dispatched = True
+            undelivered += not dispatched
+
+        for on_batch, batch in batches.items():
+            on_batch(batch)
+        return undelivered
+
+
+class FakeProducer:
+    """
+    Publishes device updates at a fixed total rate from its own thread, cycling through the
+    devices and dataitems. The records due are published together, up to max_records at a
+    time like a Kafka poll. Each record carries its publication time in BENCH_SENT_AT.
+    """
+
+    def __init__(self, topic_subscriber: FakeTopicSubscriber, devices: List[str], dataitems: List[str],
+                 rate: float, max_records: int = 500):
+        self.topic_subscriber = topic_subscriber
+        self.devices = devices
+        self.dataitems = dataitems
+        self.rate = rate
+        self.max_records = max_records
+        self.published = 0
+        self.published_by_device: Dict[str, int] = {}
+        self.undelivered = 0
+        self._stop_flag = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop_flag.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_flag.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        start = time.perf_counter()
+        count = 0
+        while not self._stop_flag.is_set():
+            # Publish on schedule, catching up without sleeping when behind
+            due = int((time.perf_counter() - start) * self.rate) + 1 - count
+            if due <= 0:
+                self._stop_flag.wait(start + count / self.rate - time.perf_counter())
+                continue
+
+            records = []
+            timestamp = format_stream_timestamp(datetime.now(STREAM_TIMEZONE).replace(tzinfo=None))
+            sent_at = time.time()
+            for _ in range(min(due, self.max_records)):
+                device = self.devices[count % len(self.devices)]
+                dataitem = self.dataitems[(count // len(self.devices)) % len(self.dataitems)]
+                records.append((device, json_codec.dumps({
+                    "ID": dataitem,
+                    "VALUE": str(count % 1000),
+                    "TIMESTAMP": timestamp,
+                    "BENCH_SENT_AT": sent_at
+                })))
+                self.published_by_device[device] = self.published_by_device.get(device, 0) + 1
+                count += 1
+            self.undelivered += self.topic_subscriber.publish(records)
+            self.published += len(records)
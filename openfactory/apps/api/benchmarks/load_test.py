@@ -0,0 +1,314 @@
+"""
+Load test of the websocket API with in-process stand-ins for ksqlDB and Kafka.
+
+OpenFactoryAPI itself is built, with the fakes injected as its ksqlDB client, topic
+subscriber and Asset factories, and serves websockets as in production. Only its
+registration as an OpenFactory asset is skipped, as it needs Kafka. Records are published
+at a fixed rate from a producer thread and simulated clients, run in separate processes,
+subscribe to the devices. Results are written as JSON. Run from openfactory/apps/api:
+
+    python -m benchmarks.load_test --devices 10 --clients 200 --rate 2000 --duration 30
+"""
+import argparse
+import asyncio
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import websockets
+
+from openfactory.apps import OpenFactoryApp
+
+from app import OpenFactoryAPI
+from config import Config
+from connection.wire_format import WireFormat
+from services.stream_service import StreamService
+from benchmarks.fakes import FakeKSQLDBClient, FakeProducer, FakeTopicSubscriber
+
+# Handshakes in progress at once per client process
+MAX_CONCURRENT_CONNECTS = 100
+
+
+class _UnregisteredApp(OpenFactoryApp):
+    """Skips the OpenFactory asset setup of OpenFactoryApp, which connects to Kafka"""
+
+    __setattr__ = object.__setattr__
+
+    def __init__(self, app_uuid, ksqlClient, bootstrap_servers, loglevel='INFO'):
+        pass
+
+
+class LoadTestAPI(OpenFactoryAPI, _UnregisteredApp):
+    """OpenFactoryAPI with ksqlDB and Kafka replaced by fakes, serving websockets without its main loop"""
+
+    def __init__(self, config: Config, ksqlClient: FakeKSQLDBClient, topic_subscriber: FakeTopicSubscriber):
+        super().__init__(
+            config,
+            app_uuid='OFA-API-LOAD-TEST',
+            ksqlClient=ksqlClient,
+            bootstrap_servers=config.kafka_brokers,
+            topic_subscriber_factory=lambda *args, **kwargs: topic_subscriber,
+            asset_factory=lambda *args, **kwargs: None
+        )
+
+    def start(self, timeout: float = 10):
+        self.websocket_thread = threading.Thread(target=self._run_websocket_server_thread, daemon=True)
+        self.websocket_thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.websocket_servers:
+            if time.monotonic() > deadline or not self.running:
+                raise RuntimeError("WebSocket server did not start")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.running = False
+        if self.websocket_thread:
+            self.websocket_thread.join(timeout=5)
+        self.app_event_loop_stopped()
+
+
+def client_urls(port: int, devices: List[str], clients: int, devices_per_client: int, wire_format: str) -> List[str]:
+    """One URL per client, spreading the clients evenly over the devices"""
+    query = f"?format={wire_format}" if wire_format != WireFormat.JSON else ""
+    urls = []
+    for index in range(clients):
+        client_devices = [devices[(index * devices_per_client + i) % len(devices)] for i in range(devices_per_client)]
+        if devices_per_client == 1:
+            urls.append(f"ws://localhost:{port}/ws/devices/{client_devices[0]}{query}")
+        else:
+            separator = "&" if query else "?"
+            urls.append(f"ws://localhost:{port}/ws/stream{query}{separator}devices={','.join(client_devices)}")
+    return urls
+
+
+def run_clients(urls: List[str], wire_format: str, measure_from, stop_event, ready_queue, result_queue):
+    """Client process: keep the connections open until stop_event is set and report what they received"""
+    result_queue.put(asyncio.run(_run_clients(urls, wire_format, measure_from, stop_event, ready_queue)))
+
+
+async def _run_clients(urls: List[str], wire_format: str, measure_from, stop_event, ready_queue) -> dict:
+    stats = {"connected": 0, "errors": 0, "frames": 0, "received": 0, "latencies": []}
+    connects = asyncio.Semaphore(MAX_CONCURRENT_CONNECTS)
+    attempts = [asyncio.Event() for _ in urls]
+    tasks = [
+        asyncio.create_task(_client(url, WireFormat(wire_format), measure_from, stats, connects, attempted))
+        for url, attempted in zip(urls, attempts)
+    ]
+    for attempted in attempts:
+        await attempted.wait()
+    ready_queue.put(stats["connected"])
+
+    await asyncio.get_running_loop().run_in_executor(None, stop_event.wait)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return stats
+
+
+async def _client(url: str, wire_format: WireFormat, measure_from, stats: dict,
+                  connects: asyncio.Semaphore, attempted: asyncio.Event):
+    try:
+        async with connects:
+            websocket = await websockets.connect(url, max_size=None)
+    except Exception:
+        stats["errors"] += 1
+        attempted.set()
+        return
+
+    stats["connected"] += 1
+    attempted.set()
+    latencies = stats["latencies"]
+    try:
+        async for frame in websocket:
+            now = time.time()
+            stats["frames"] += 1
+            message = wire_format.decode(frame)
+            messages = message.get("messages", ()) if message.get("event") == "batch" else (message,)
+            for message in messages:
+                sent_at = (message.get("data") or {}).get("BENCH_SENT_AT")
+                if sent_at is None:
+                    continue
+                stats["received"] += 1
+                if sent_at >= measure_from.value:
+                    latencies.append(now - sent_at)
+    except websockets.exceptions.ConnectionClosed:
+        stats["errors"] += 1
+    finally:
+        await websocket.close()
+
+
+def rss_bytes() -> int:
+    """Resident memory of this process (peak resident memory where /proc is unavailable)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    """Latency percentiles in milliseconds (nearest rank)"""
+    if not latencies:
+        return {"samples": 0}
+    latencies = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return round(latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000, 3)
+
+    return {
+        "samples": len(latencies),
+        "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": round(latencies[-1] * 1000, 3),
+    }
+
+
+def run(args) -> dict:
+    devices = [f"{args.device_prefix}{index:03d}" for index in range(args.devices)]
+    dataitems = [f"bench_item_{index}" for index in range(args.dataitems)]
+    config = Config(
+        websocket_port=args.port,
+        stream_mode=args.stream_mode,
+        compression=args.compression,
+        max_queue_size=args.queue_size,
+        overflow_policy=args.overflow_policy,
+    )
+    topic_subscriber = FakeTopicSubscriber()
+    ksqlClient = FakeKSQLDBClient(devices, dataitems, args.ksql_latency)
+    api = LoadTestAPI(config, ksqlClient, topic_subscriber)
+    api.start()
+
+    gc.collect()
+    rss_before = rss_bytes()
+
+    urls = client_urls(args.port, devices, args.clients, args.devices_per_client, args.format)
+    context = multiprocessing.get_context("spawn")
+    measure_from = context.Value("d", float("inf"), lock=False)
+    stop_event = context.Event()
+    ready_queue = context.Queue()
+    result_queue = context.Queue()
+    processes = [
+        context.Process(
+            target=run_clients,
+            args=(urls[index::args.client_processes], args.format, measure_from, stop_event, ready_queue, result_queue)
+        )
+        for index in range(min(args.client_processes, len(urls)))
+    ]
+    for process in processes:
+        process.start()
+    connected = sum(ready_queue.get() for _ in processes)
+
+    # Subscriptions finish after the handshake, wait until the server has them all
+    deadline = time.monotonic() + 30
+    while len(api.connection_manager.message_queues) < connected and time.monotonic() < deadline:
+        time.sleep(0.1)
+    gc.collect()
+    rss_connected = rss_bytes()
+
+    producer = FakeProducer(topic_subscriber, devices, dataitems, args.rate, args.max_records)
+    measure_from.value = time.time() + args.warmup
+    producer.start()
+    time.sleep(args.warmup)
+    published_before = producer.published
+    started = time.perf_counter()
+    time.sleep(args.duration)
+    elapsed = time.perf_counter() - started
+    published = producer.published - published_before
+    producer.stop()
+
+    time.sleep(args.drain)
+    stop_event.set()
+    client_results = [result_queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    rss_after = rss_bytes()
+    overflow = dict(api.connection_manager.overflow_stats)
+    api.stop()
+
+    subscribers: Dict[str, int] = {}
+    for index in range(args.clients):
+        for i in range(args.devices_per_client):
+            device = devices[(index * args.devices_per_client + i) % len(devices)]
+            subscribers[device] = subscribers.get(device, 0) + 1
+    expected = sum(count * subscribers.get(device, 0) for device, count in producer.published_by_device.items())
+    received = sum(result["received"] for result in client_results)
+    latencies = [latency for result in client_results for latency in result["latencies"]]
+
+    return {
+        "benchmark": "websocket_api_load",
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "results": {
+            "connections": connected,
+            "connection_errors": sum(result["errors"] for result in client_results),
+            "published": producer.published,
+            "publish_rate": round(published / elapsed, 1),
+            "expected_deliveries": expected,
+            "delivered": received,
+            "delivery_ratio": round(received / expected, 4) if expected else None,
+            "delivery_rate": round(len(latencies) / elapsed, 1),
+            "frames": sum(result["frames"] for result in client_results),
+            "latency_ms": latency_summary(latencies),
+            "memory_per_connection_bytes": (rss_connected - rss_before) // connected if connected else None,
+            "rss_bytes": {"before_clients": rss_before, "clients_connected": rss_connected, "after_run": rss_after},
+            "overflow": overflow,
+            "ksql_queries": ksqlClient.queries + ksqlClient.statements,
+        },
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the OpenFactory websocket API")
+    parser.add_argument("--devices", type=int, default=10, help="Number of simulated devices")
+    parser.add_argument("--dataitems", type=int, default=5, help="Dataitems per device")
+    parser.add_argument("--device-prefix", default="BENCH-", help="Prefix of the simulated device UUIDs")
+    parser.add_argument("--clients", type=int, default=100, help="Number of websocket clients")
+    parser.add_argument("--devices-per-client", type=int, default=1,
+                        help="Devices per client, more than 1 uses multiplexed /ws/stream connections")
+    parser.add_argument("--client-processes", type=int, default=1, help="Processes running the clients")
+    parser.add_argument("--rate", type=float, default=1000, help="Records published per second, all devices together")
+    parser.add_argument("--duration", type=float, default=30, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="Seconds of publishing before measuring")
+    parser.add_argument("--drain", type=float, default=2, help="Seconds left to deliver queued messages at the end")
+    parser.add_argument("--format", default=WireFormat.JSON, choices=WireFormat.available_formats())
+    parser.add_argument("--stream-mode", default=StreamService.PER_DEVICE, choices=[StreamService.PER_DEVICE, StreamService.SHARED])
+    parser.add_argument("--compression", default="none", choices=["none", "deflate"])
+    parser.add_argument("--queue-size", type=int, default=Config.max_queue_size)
+    parser.add_argument("--overflow-policy", default=Config.overflow_policy)
+    parser.add_argument("--max-records", type=int, default=Config.kafka_max_records,
+                        help="Records delivered to the API at once when publishing falls behind")
+    parser.add_argument("--ksql-latency", type=float, default=0.0, help="Seconds added to every ksqlDB call")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file ('-' for stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    if args.output == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        results = report["results"]
+        print(
+            f"{results['connections']} connections, {results['publish_rate']} records/s published, "
+            f"{results['delivery_rate']} messages/s delivered, p50 {results['latency_ms'].get('p50')} ms, "
+            f"p99 {results['latency_ms'].get('p99')} ms, {results['memory_per_connection_bytes']} bytes/connection "
+            f"-> {args.output}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,53 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Dict, Tuple
 
 @dataclass
 class Config:
     ksqldb_url: str = "http://ksqldb-server:8088"
+    # ksqlDB calls run in a pool of this many threads, and give up after ksqldb_timeout seconds
+    ksqldb_max_workers: int = 4
+    ksqldb_timeout: float = 10
     kafka_brokers: str = "broker:29092"
+    kafka_group_id: str = "ofa_api_stream_group"
+    # Records handed to the event loop at once, and milliseconds spent filling a batch
+    kafka_max_records: int = 500
+    kafka_linger_ms: int = 0
+    stream_mode: str = "per_device"
+    shared_stream_topic: str = "ofa_api_devices"
+    shared_stream_partitions: int = 6
     websocket_host: str = "0.0.0.0"
     websocket_port: int = 8000
+    # Number of worker processes sharing websocket_port, each also listening on websocket_port + 1 + index
+    workers: int = 1
+    # Host put in redirects to a worker's own port (the Host header of the request if empty)
+    worker_host: str = ""
     ping_interval: int = 30
     ping_timeout: int = 10
+    # Seconds without any frame sent before a connection gets a ping event (0 relies on protocol pings only)
+    heartbeat_interval: float = 30
+    # Seconds a device stays consumed after its last connection left, before its stream is dropped (0 keeps it)
+    device_idle_ttl: float = 0
+    # Enrichment stages (IVAC durations, DUSTTRAK averages) running at once
+    enrichment_concurrency: int = 4
+    # permessage-deflate settings ("none" disables compression)
+    compression: str = "deflate"
+    compression_level: int = 6
+    compression_mem_level: int = 5
+    compression_window_bits: int = 12
     message_timeout: int = 30
+    max_queue_size: int = 10000
+    overflow_policy: str = "drop_oldest"
+    # Messages kept per device so reconnecting clients can resume from their last sequence number
+    replay_buffer_size: int = 1000
+    device_cache_ttl: float = 30
+    # Moving average window (size, advance) in seconds by dataitem, as in moving_average.sql
+    moving_average_windows: Dict[str, Tuple[int, int]] = field(default_factory=lambda: {
+        'pm1_concentration': (10, 5),
+        'pm2_5_concentration': (10, 5),
+        'pm4_concentration': (10, 5),
+        'pm10_concentration': (10, 5),
+    })
+    # Samples kept per (device, dataitem) for the history method, and their maximum age in seconds
+    history_max_samples: int = 1000
+    history_max_age: float = 3600
     log_level: str = "INFO"
\ No newline at end of file
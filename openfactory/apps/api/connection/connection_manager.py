@@ -1,57 +1,252 @@
 import asyncio
-import json
 from collections import defaultdict
-from typing import Dict, Set
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 from websockets.server import WebSocketServerProtocol
 
+from connection.connection_queue import ConnectionQueue
+from connection.dataitem_filter import DataitemFilter
+from connection.replay_buffer import ReplayBuffer
+from connection.wire_format import OutboundMessage, WireFormat
+
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, max_queue_size: int = 0, overflow_policy: str = ConnectionQueue.DROP_OLDEST,
+                 replay_buffer_size: int = 1000, replay_epoch: Optional[str] = None):
         self.device_connections: Dict[str, Set[WebSocketServerProtocol]] = defaultdict(set)
-        self.connection_to_device: Dict[WebSocketServerProtocol, str] = {}
-        self.message_queues: Dict[WebSocketServerProtocol, asyncio.Queue] = {}
+        self.connection_devices: Dict[WebSocketServerProtocol, Set[str]] = {}
+        self.message_queues: Dict[WebSocketServerProtocol, ConnectionQueue] = {}
+        self.wire_formats: Dict[WebSocketServerProtocol, WireFormat] = {}
+        self.default_wire_format = WireFormat()
+        # Immutable snapshot of each device's (connection, queue) pairs, rebuilt only when connections change
+        self._device_queues: Dict[str, Tuple[Tuple[WebSocketServerProtocol, ConnectionQueue], ...]] = {}
+        # Dataitems each connection wants from a device, absent for all of them
+        self.dataitem_filters: Dict[Tuple[WebSocketServerProtocol, str], DataitemFilter] = {}
+        # For devices with filtered connections, the queues wanting each dataitem, filled as dataitems
+        # are seen and reset with the snapshot
+        self._dataitem_queues: Dict[str, Dict[str, Tuple[Tuple[WebSocketServerProtocol, ConnectionQueue], ...]]] = {}
         self._lock = asyncio.Lock()
-    
-    async def add_connection(self, websocket: WebSocketServerProtocol, device_uuid: str):
-        """Add a new WebSocket connection for a device"""
+        self.replay_buffer = ReplayBuffer(replay_buffer_size, replay_epoch)
+        # Called with a device UUID when the last connection to the device leaves
+        self._idle_callback: Optional[Callable[[str], None]] = None
+        # Connections being closed for overflowing, and the tasks closing them
+        self._closing: Set[WebSocketServerProtocol] = set()
+        self._closing_tasks: Set[asyncio.Task] = set()
+
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.overflow_stats = {
+            ConnectionQueue.DROPPED: 0,
+            ConnectionQueue.CONFLATED: 0,
+            "disconnected": 0
+        }
+
+    def _refresh_device_queues(self, device_uuid: str):
+        """Rebuild the broadcast snapshot for a device"""
+        queues = tuple(
+            (connection, self.message_queues[connection])
+            for connection in self.device_connections.get(device_uuid, ())
+            if connection in self.message_queues
+        )
+        if queues:
+            self._device_queues[device_uuid] = queues
+        else:
+            self._device_queues.pop(device_uuid, None)
+        if any((connection, device_uuid) in self.dataitem_filters for connection, _ in queues):
+            self._dataitem_queues[device_uuid] = {}
+        else:
+            self._dataitem_queues.pop(device_uuid, None)
+
+    def _dataitem_index(self, device_uuid: str, dataitem_id: str):
+        """Queues of the device's connections whose filter lets a dataitem through"""
+        index = self._dataitem_queues[device_uuid]
+        queues = index.get(dataitem_id)
+        if queues is None:
+            queues = index[dataitem_id] = tuple(
+                (connection, queue) for connection, queue in self._device_queues.get(device_uuid, ())
+                if self._wants(connection, device_uuid, dataitem_id)
+            )
+        return queues
+
+    def _wants(self, websocket: WebSocketServerProtocol, device_uuid: str, dataitem_id: Optional[str]) -> bool:
+        dataitem_filter = self.dataitem_filters.get((websocket, device_uuid))
+        return dataitem_filter is None or dataitem_id is None or dataitem_filter.matches(dataitem_id)
+
+    async def add_connection(self, websocket: WebSocketServerProtocol, device_uuids: Iterable[str] = (),
+                             max_queue_size: int = None, overflow_policy: str = None, max_rate: float = 0,
+                             wire_format: WireFormat = None):
+        """Add a new WebSocket connection, subscribed to the given devices"""
+        queue = ConnectionQueue(
+            self.max_queue_size if max_queue_size is None else max_queue_size,
+            overflow_policy or self.overflow_policy
+        )
+        queue.set_max_rate(max_rate)
+        async with self._lock:
+            self.message_queues[websocket] = queue
+            self.wire_formats[websocket] = wire_format or self.default_wire_format
+            self.connection_devices[websocket] = set()
+            for device_uuid in device_uuids:
+                self._subscribe(websocket, device_uuid)
+
+    async def subscribe_device(self, websocket: WebSocketServerProtocol, device_uuid: str,
+                               last_seq: Optional[int] = None, epoch: Optional[str] = None,
+                               dataitem_filter: Optional[DataitemFilter] = None,
+                               initial_message: Optional[Dict] = None,
+                               snapshot_seq: Optional[int] = None) -> Optional[Dict]:
+        """
+        Add a device to the subscriptions of a connection, receiving only the dataitems
+        passing dataitem_filter if given (replacing the filter of a previous subscription).
+
+        initial_message, the device's data as of its sequence number snapshot_seq, is queued
+        first. If last_seq is given, the messages buffered since then are queued next, preceded
+        by a 'resumed' event which is also returned. Otherwise those buffered since snapshot_seq
+        are, so nothing broadcast while initial_message was built is missed.
+        """
+        async with self._lock:
+            if websocket not in self.connection_devices:
+                return None
+            if dataitem_filter is not None:
+                self.dataitem_filters[(websocket, device_uuid)] = dataitem_filter
+            else:
+                self.dataitem_filters.pop((websocket, device_uuid), None)
+            if initial_message is not None:
+                self.message_queues[websocket].put_nowait(OutboundMessage(initial_message))
+            resumed = None
+            if last_seq is not None:
+                resumed = self._queue_replay(websocket, device_uuid, last_seq, epoch)
+            elif snapshot_seq is not None and self.replay_buffer.continues(device_uuid, snapshot_seq):
+                self._queue_buffered(websocket, device_uuid, self.replay_buffer.since(device_uuid, snapshot_seq)[0])
+            self._subscribe(websocket, device_uuid)
+            return resumed
+
+    def _queue_replay(self, websocket: WebSocketServerProtocol, device_uuid: str,
+                      last_seq: int, epoch: Optional[str]) -> Dict:
+        messages, complete = self.replay_buffer.since(device_uuid, last_seq, epoch)
+        resumed = {
+            "event": "resumed",
+            "device_uuid": device_uuid,
+            "epoch": self.replay_buffer.epoch,
+            "from_seq": last_seq,
+            "replayed": len(messages),
+            "complete": complete,
+            # Sequence numbers restarted, the client must forget the ones it kept for this device
+            "reset": not self.replay_buffer.continues(device_uuid, last_seq, epoch)
+        }
+        self.message_queues[websocket].put_nowait(OutboundMessage(resumed))
+        self._queue_buffered(websocket, device_uuid, messages)
+        return resumed
+
+    def _queue_buffered(self, websocket: WebSocketServerProtocol, device_uuid: str, messages: List[OutboundMessage]):
+        queue = self.message_queues[websocket]
+        for payload in messages:
+            if self._wants(websocket, device_uuid, payload.message.get("data", {}).get("ID")):
+                queue.put_nowait(payload.replay())
+
+    async def unsubscribe_device(self, websocket: WebSocketServerProtocol, device_uuid: str):
+        """Remove a device from the subscriptions of a connection"""
         async with self._lock:
-            self.device_connections[device_uuid].add(websocket)
-            self.connection_to_device[websocket] = device_uuid
-            self.message_queues[websocket] = asyncio.Queue()
-    
+            if device_uuid in self.connection_devices.get(websocket, ()):
+                self._unsubscribe(websocket, device_uuid)
+
+    def set_idle_callback(self, callback: Callable[[str], None]):
+        """Register the function called when a device has no connection left"""
+        self._idle_callback = callback
+
+    def _subscribe(self, websocket: WebSocketServerProtocol, device_uuid: str):
+        self.device_connections[device_uuid].add(websocket)
+        self.connection_devices[websocket].add(device_uuid)
+        self._refresh_device_queues(device_uuid)
+
+    def _unsubscribe(self, websocket: WebSocketServerProtocol, device_uuid: str):
+        connections = self.device_connections[device_uuid]
+        connections.discard(websocket)
+        self.connection_devices[websocket].discard(device_uuid)
+        self.dataitem_filters.pop((websocket, device_uuid), None)
+        self._refresh_device_queues(device_uuid)
+        if not connections:
+            del self.device_connections[device_uuid]
+            if self._idle_callback:
+                self._idle_callback(device_uuid)
+
     async def remove_connection(self, websocket: WebSocketServerProtocol):
         """Remove a WebSocket connection"""
         async with self._lock:
-            if websocket in self.connection_to_device:
-                device_uuid = self.connection_to_device[websocket]
-                self.device_connections[device_uuid].discard(websocket)
-                del self.connection_to_device[websocket]
+            if websocket in self.connection_devices:
+                for device_uuid in list(self.connection_devices[websocket]):
+                    self._unsubscribe(websocket, device_uuid)
+                del self.connection_devices[websocket]
                 if websocket in self.message_queues:
                     del self.message_queues[websocket]
+                self.wire_formats.pop(websocket, None)
 
     async def cleanup_all_connections(self):
-        for websocket in self.connection_to_device.keys():
+        for websocket in list(self.connection_devices.keys()):
             await self.remove_connection(websocket)
-    
-    async def broadcast_to_device_connections(self, device_uuid: str, message: Dict):
-        """Broadcast a message to all connections for a specific device"""
-        if device_uuid not in self.device_connections:
+
+    async def broadcast_to_device_connections(self, device_uuid: str, message: Dict, received_at: float = None,
+                                              raw_data: bytes = None):
+        """
+        Broadcast a message to all connections for a specific device. raw_data is the
+        Kafka value of a stream message's data, forwarded without encoding it again
+        """
+        # Sequenced and buffered even without listeners, so reconnecting clients can catch up
+        payload = self.replay_buffer.append(device_uuid, message, received_at, raw_data)
+        dataitem_id = message.get("data", {}).get("ID")
+        if device_uuid in self._dataitem_queues and dataitem_id is not None:
+            queues = self._dataitem_index(device_uuid, dataitem_id)
+        else:
+            queues = self._device_queues.get(device_uuid)
+        if not queues:
             return
-        
-        connections_copy = self.device_connections[device_uuid].copy()
-        for connection in connections_copy:
-            if connection in self.message_queues:
-                queue = self.message_queues[connection]
-                try:
-                    await queue.put(json.dumps(message))
-                except Exception as e:
-                    print(f"Error queuing message for connection: {e}")
-                    await self.remove_connection(connection)
+
+        # Enrichments of a dataitem conflate with each other, not with its raw values
+        key = (device_uuid, dataitem_id, message.get("event")) if dataitem_id is not None else None
+        for connection, queue in queues:
+            outcome = queue.put_nowait(payload, key)
+            if outcome == ConnectionQueue.QUEUED:
+                continue
+            if outcome == ConnectionQueue.OVERFLOWED:
+                if connection in self._closing:
+                    continue
+                self._closing.add(connection)
+                self.overflow_stats["disconnected"] += 1
+                task = asyncio.create_task(self._disconnect_slow_consumer(connection))
+                self._closing_tasks.add(task)
+                task.add_done_callback(self._closing_tasks.discard)
+            else:
+                self.overflow_stats[outcome] += 1
+
+    async def _disconnect_slow_consumer(self, websocket: WebSocketServerProtocol):
+        """Close a connection whose queue overflowed with the 'disconnect' policy"""
+        try:
+            await self.remove_connection(websocket)
+            await websocket.close(code=1008, reason="Slow consumer: message queue overflow")
+        except Exception as e:
+            print(f"Error closing slow consumer connection: {e}")
+        finally:
+            self._closing.discard(websocket)
 
     def get_connection_count(self, device_uuid: str) -> int:
         """Get the number of active connections for a device"""
-        return len(self.device_connections[device_uuid])
-    
-    def get_message_queue(self, websocket: WebSocketServerProtocol) -> asyncio.Queue:
+        return len(self.device_connections.get(device_uuid, ()))
+
+    def get_connection_devices(self, websocket: WebSocketServerProtocol) -> Set[str]:
+        """Get the devices a connection is subscribed to"""
+        return set(self.connection_devices.get(websocket, ()))
+
+    def get_message_queue(self, websocket: WebSocketServerProtocol) -> ConnectionQueue:
         """Get the message queue for a connection"""
-        return self.message_queues.get(websocket)
\ No newline at end of file
+        return self.message_queues.get(websocket)
+
+    def get_dataitem_filter(self, websocket: WebSocketServerProtocol, device_uuid: str) -> Optional[DataitemFilter]:
+        """Get the filter of a connection's subscription to a device (None for all dataitems)"""
+        return self.dataitem_filters.get((websocket, device_uuid))
+
+    def get_wire_format(self, websocket: WebSocketServerProtocol) -> WireFormat:
+        """Get the encoding negotiated by a connection (JSON if not registered)"""
+        return self.wire_formats.get(websocket, self.default_wire_format)
+
+    def get_queue_stats(self) -> Dict[str, int]:
+        """Get overflow counters and the number of currently pending messages"""
+        stats = dict(self.overflow_stats)
+        stats["pending"] = sum(queue.qsize() for queue in self.message_queues.values())
+        return stats
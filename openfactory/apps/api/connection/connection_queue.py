@@ -0,0 +1,140 @@
+import asyncio
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, List, Optional
+
+
+# Payload of a cell whose message was conflated into a newer cell further back
+_SUPERSEDED = object()
+
+
+class ConnectionQueue:
+    """
+    Bounded outgoing message queue of a single WebSocket connection.
+
+    A conflated message moves to the back of the queue with its new payload, so the
+    messages of a device always leave in the order they were broadcast (by seq).
+    """
+
+    DROP_OLDEST = "drop_oldest"
+    CONFLATE = "conflate"
+    DISCONNECT = "disconnect"
+    OVERFLOW_POLICIES = (DROP_OLDEST, CONFLATE, DISCONNECT)
+
+    QUEUED = "queued"
+    DROPPED = "dropped"
+    CONFLATED = "conflated"
+    OVERFLOWED = "overflowed"
+
+    def __init__(self, maxsize: int = 0, overflow_policy: str = DROP_OLDEST):
+        """
+        Args:
+            maxsize: Maximum number of pending messages (0 means unbounded)
+            overflow_policy: What to do when a message arrives on a full queue
+        """
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        # Each entry is a mutable [key, payload] cell so conflation can replace it in place
+        self._items: Deque[List[Any]] = deque()
+        self._latest: Dict[Hashable, List[Any]] = {}
+        # Pending payloads, _items also holding superseded cells until they reach the front
+        self._size = 0
+        self._not_empty = asyncio.Event()
+        self.dropped = 0
+        self.conflated = 0
+        # Maximum number of batched deliveries per second (0 for lossless delivery)
+        self.max_rate = 0
+
+    def set_max_rate(self, max_rate: float):
+        """Switch between lossless delivery (0) and rate-capped delivery of the latest values"""
+        self.max_rate = max_rate
+        if not self._conflating():
+            self._latest.clear()
+
+    def _conflating(self) -> bool:
+        return bool(self.max_rate) or self.overflow_policy == self.CONFLATE
+
+    def put_nowait(self, payload: Any, key: Optional[Hashable] = None) -> str:
+        """
+        Queue a payload without blocking, applying the overflow policy if full.
+
+        Returns:
+            One of QUEUED, DROPPED, CONFLATED or OVERFLOWED. OVERFLOWED means the
+            payload was rejected and the connection should be disconnected.
+        """
+        if self.max_rate and key is not None and key in self._latest:
+            self._conflate(key, payload)
+            return self.CONFLATED
+
+        outcome = self.QUEUED
+        if self.maxsize and self._size >= self.maxsize:
+            if self.overflow_policy == self.DISCONNECT:
+                return self.OVERFLOWED
+
+            if self.overflow_policy == self.CONFLATE and key is not None and key in self._latest:
+                self._conflate(key, payload)
+                return self.CONFLATED
+
+            self._pop_oldest()
+            self.dropped += 1
+            outcome = self.DROPPED
+
+        self._append(key, payload)
+        return outcome
+
+    def _append(self, key: Optional[Hashable], payload: Any):
+        cell = [key, payload]
+        self._items.append(cell)
+        self._size += 1
+        if key is not None and self._conflating():
+            self._latest[key] = cell
+        self._not_empty.set()
+
+    def _conflate(self, key: Hashable, payload: Any):
+        """Replace the pending payload of a key, moving it behind the payloads queued since"""
+        self._latest.pop(key)[1] = _SUPERSEDED
+        self._size -= 1
+        self._append(key, payload)
+        self.conflated += 1
+        if len(self._items) > 2 * self._size + 64:
+            # Drop the superseded cells of a queue conflating without being drained
+            self._items = deque(cell for cell in self._items if cell[1] is not _SUPERSEDED)
+
+    def _pop_oldest(self) -> Any:
+        """Remove and return the oldest pending payload (the queue must not be empty)"""
+        while True:
+            cell = self._items.popleft()
+            if cell[1] is not _SUPERSEDED:
+                self._size -= 1
+                self._forget(cell)
+                return cell[1]
+
+    async def get(self) -> Any:
+        """Wait for and return the oldest pending payload"""
+        while not self._size:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self._pop_oldest()
+
+    async def get_batch(self) -> List[Any]:
+        """Wait for pending payloads and return all of them, oldest first"""
+        while not self._size:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        payloads = [cell[1] for cell in self._items if cell[1] is not _SUPERSEDED]
+        self._items.clear()
+        self._latest.clear()
+        self._size = 0
+        return payloads
+
+    def _forget(self, cell: List[Any]):
+        """Drop the conflation index entry pointing at a cell leaving the queue"""
+        if self._latest.get(cell[0]) is cell:
+            del self._latest[cell[0]]
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return not self._size
@@ -0,0 +1,62 @@
+import re
+from fnmatch import translate
+from typing import Dict, Iterable, Optional, Union
+
+
+class DataitemFilter:
+    """
+    Dataitems a connection wants from a device, as include and exclude lists whose entries
+    are exact dataitem IDs or glob patterns ('pm*', 'v?', ...).
+
+    A dataitem passes if it matches an include entry (any dataitem if there is no include
+    list) and no exclude entry.
+    """
+
+    GLOB_CHARS = frozenset("*?[")
+
+    def __init__(self, include: Iterable[str] = None, exclude: Iterable[str] = None):
+        self.include = None if include is None else sorted(set(include))
+        self.exclude = sorted(set(exclude or ()))
+        self._include = None if include is None else self._compile(self.include)
+        self._exclude = self._compile(self.exclude)
+
+    @classmethod
+    def parse(cls, include: Union[str, Iterable[str], None] = None,
+              exclude: Union[str, Iterable[str], None] = None) -> Optional['DataitemFilter']:
+        """Build a filter from lists or comma separated strings, None if both are empty"""
+        include = cls._parse_entries(include)
+        exclude = cls._parse_entries(exclude)
+        if not include and not exclude:
+            return None
+        return cls(include or None, exclude)
+
+    @staticmethod
+    def _parse_entries(entries) -> list:
+        if entries is None:
+            return []
+        if isinstance(entries, str):
+            entries = entries.split(",")
+        if not isinstance(entries, (list, tuple, set)):
+            raise ValueError("include and exclude must be lists of dataitem IDs or patterns")
+        return [str(entry).strip() for entry in entries if str(entry).strip()]
+
+    @classmethod
+    def _compile(cls, entries: list):
+        """Split entries into a set of exact IDs and a single regex for the patterns"""
+        exact = frozenset(entry for entry in entries if not cls.GLOB_CHARS & set(entry))
+        patterns = [translate(entry) for entry in entries if entry not in exact]
+        return exact, re.compile("|".join(patterns)) if patterns else None
+
+    @staticmethod
+    def _matches_any(compiled, dataitem_id: str) -> bool:
+        exact, pattern = compiled
+        return dataitem_id in exact or (pattern is not None and pattern.match(dataitem_id) is not None)
+
+    def matches(self, dataitem_id: str) -> bool:
+        if self._include is not None and not self._matches_any(self._include, dataitem_id):
+            return False
+        return not self._matches_any(self._exclude, dataitem_id)
+
+    def apply(self, dataitems: Dict[str, object]) -> Dict[str, object]:
+        """Keep the entries of a {dataitem ID: value} mapping that pass the filter"""
+        return {dataitem_id: value for dataitem_id, value in dataitems.items() if self.matches(dataitem_id)}
@@ -0,0 +1,107 @@
+import asyncio
+import math
+import time
+from typing import Awaitable, Callable, Dict, List, Set
+
+from websockets.server import WebSocketServerProtocol
+
+
+class HeartbeatScheduler:
+    """
+    Sends a heartbeat to connections that sent nothing for `interval` seconds, from a single
+    timer wheel shared by all connections.
+
+    Sending only records the time of the last activity; a connection is checked when its
+    wheel slot comes up and rescheduled at its new due time if it was active meanwhile.
+    """
+
+    def __init__(self, interval: float = 30, tick: float = 1.0):
+        """
+        Args:
+            interval: Idle seconds before a heartbeat is sent (0 disables heartbeats)
+            tick: Resolution of the wheel in seconds
+        """
+        self.interval = interval
+        self.tick = tick
+        self._slots: List[Set[WebSocketServerProtocol]] = [
+            set() for _ in range(max(math.ceil(interval / tick), 1) + 1)
+        ]
+        self._cursor = 0
+        self._last_activity: Dict[WebSocketServerProtocol, float] = {}
+        self._send_heartbeat: Dict[WebSocketServerProtocol, Callable[[], Awaitable]] = {}
+        self._task = None
+        # Heartbeats being sent, referenced until done as the loop only keeps weak references
+        self._sending: Set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def start(self):
+        """Start the wheel task on the running event loop"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Cancel the wheel task and the heartbeats being sent"""
+        tasks = list(self._sending)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def register(self, websocket: WebSocketServerProtocol, send_heartbeat: Callable[[], Awaitable]):
+        """Watch a connection, calling send_heartbeat() whenever it has been idle for the interval"""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        self._last_activity[websocket] = now
+        self._send_heartbeat[websocket] = send_heartbeat
+        self._schedule(websocket, now + self.interval, now)
+
+    def unregister(self, websocket: WebSocketServerProtocol):
+        # Left in its slot, it is skipped when the slot comes up
+        self._last_activity.pop(websocket, None)
+        self._send_heartbeat.pop(websocket, None)
+
+    def touch(self, websocket: WebSocketServerProtocol):
+        """Record that something was sent on a connection"""
+        if websocket in self._last_activity:
+            self._last_activity[websocket] = time.monotonic()
+
+    def _schedule(self, websocket: WebSocketServerProtocol, due: float, now: float):
+        ticks = min(max(math.ceil((due - now) / self.tick), 1), len(self._slots) - 1)
+        self._slots[(self._cursor + ticks) % len(self._slots)].add(websocket)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            due = self._slots[self._cursor]
+            self._slots[self._cursor] = set()
+
+            now = time.monotonic()
+            for websocket in due:
+                last_activity = self._last_activity.get(websocket)
+                if last_activity is None:
+                    continue
+                next_due = last_activity + self.interval
+                if next_due <= now + self.tick / 2:
+                    self._last_activity[websocket] = now
+                    next_due = now + self.interval
+                    task = asyncio.create_task(self._heartbeat(websocket))
+                    self._sending.add(task)
+                    task.add_done_callback(self._sending.discard)
+                self._schedule(websocket, next_due, now)
+
+    async def _heartbeat(self, websocket: WebSocketServerProtocol):
+        send_heartbeat = self._send_heartbeat.get(websocket)
+        if send_heartbeat is None:
+            return
+        try:
+            await send_heartbeat()
+        except Exception:
+            # A closed connection is unregistered by its handler
+            pass
@@ -0,0 +1,66 @@
+import uuid
+from collections import deque
+from itertools import islice
+from typing import Deque, Dict, List, Optional, Tuple
+
+from connection.wire_format import OutboundMessage
+
+
+class ReplayBuffer:
+    """Per-device sequence numbers and a bounded ring buffer of the latest broadcast messages"""
+
+    def __init__(self, size: int = 1000, epoch: Optional[str] = None):
+        """
+        Args:
+            size: Number of messages kept per device for replay (0 disables replay)
+            epoch: Identifier of the sequence space, shared by the workers of one API run
+        """
+        self.size = size
+        # A client resuming with another epoch missed a restart
+        self.epoch = epoch or self.new_epoch()
+        self._sequences: Dict[str, int] = {}
+        self._buffers: Dict[str, Deque[OutboundMessage]] = {}
+
+    @staticmethod
+    def new_epoch() -> str:
+        return uuid.uuid4().hex[:12]
+
+    def append(self, device_uuid: str, message: Dict, received_at: float = None,
+               raw_data: bytes = None) -> OutboundMessage:
+        """Stamp a message with the device's next sequence number and keep it for replay"""
+        seq = self._sequences.get(device_uuid, 0) + 1
+        self._sequences[device_uuid] = seq
+        message["seq"] = seq
+
+        payload = OutboundMessage(message, received_at, raw_data)
+        if self.size:
+            buffer = self._buffers.get(device_uuid)
+            if buffer is None:
+                buffer = self._buffers[device_uuid] = deque(maxlen=self.size)
+            buffer.append(payload)
+        return payload
+
+    def last_sequence(self, device_uuid: str) -> int:
+        return self._sequences.get(device_uuid, 0)
+
+    def continues(self, device_uuid: str, last_seq: int, epoch: Optional[str] = None) -> bool:
+        """Whether a client's last sequence number belongs to the current sequence space"""
+        return (epoch is None or epoch == self.epoch) and last_seq <= self.last_sequence(device_uuid)
+
+    def since(self, device_uuid: str, last_seq: int, epoch: Optional[str] = None) -> Tuple[List[OutboundMessage], bool]:
+        """
+        Get the messages of a device sent after last_seq.
+
+        Returns:
+            The buffered messages, oldest first, and whether they cover everything the
+            client missed (False if some were already evicted or the epoch changed).
+        """
+        buffer = self._buffers.get(device_uuid, ())
+        if not self.continues(device_uuid, last_seq, epoch):
+            return list(buffer), False
+        current = self.last_sequence(device_uuid)
+
+        # Sequence numbers in a buffer are contiguous, so the position follows from the oldest one
+        first = current - len(buffer) + 1
+        complete = last_seq + 1 >= first
+        return list(islice(buffer, max(last_seq + 1 - first, 0), None)), complete
@@ -1,73 +1,226 @@
 import asyncio
-import json
 import time
-from queue import Queue
+from collections import deque
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlsplit
 from models import ClientMessage
 from websockets.exceptions import ConnectionClosed
 from websockets.server import WebSocketServerProtocol
 
+import json_codec
 from exceptions import DeviceNotFoundException, StreamCreationException
+from metrics import DELIVERY_LATENCY, FRAMES_SENT, MESSAGES_RECEIVED
 from connection.connection_manager import ConnectionManager
+from connection.connection_queue import ConnectionQueue
+from connection.dataitem_filter import DataitemFilter
+from connection.heartbeat import HeartbeatScheduler
+from connection.wire_format import WireFormat
+from connection.worker_router import WorkerRouter
 from services.device_service import DeviceService
+from services.enrichment import EnrichmentPipeline
 from services.stream_service import StreamService
 
 
 class WebsocketsManager:
     def __init__(self, connection_manager: ConnectionManager, device_service: DeviceService, 
-                 stream_service: StreamService, topic_subscriber, openfactory_app):
+                 stream_service: StreamService, topic_subscriber, openfactory_app,
+                 worker_router: WorkerRouter = None, heartbeat_interval: float = 30,
+                 device_idle_ttl: float = 0, enrichment_concurrency: int = 4):
         self.connection_manager = connection_manager
+        self.worker_router = worker_router or WorkerRouter()
+        self.heartbeats = HeartbeatScheduler(heartbeat_interval)
         self.device_service = device_service
         self.stream_service = stream_service
         self.topic_subscriber = topic_subscriber
         self.openfactory_app = openfactory_app
         self.device_assets = {}
         self.device_topics = {}
+        # Seconds a device without connections stays consumed before it is released (0 for never)
+        self.device_idle_ttl = device_idle_ttl
+        self._initializing: Dict[str, asyncio.Task] = {}
+        self._releasing: Dict[str, asyncio.Task] = {}
+        self._release_timers: Dict[str, asyncio.TimerHandle] = {}
+        self.connection_manager.set_idle_callback(self._on_device_idle)
         
-        self.message_queue = Queue()
+        # Derived values are sent after the raw messages, as separate 'enrichment' events
+        self.enrichment = EnrichmentPipeline(enrichment_concurrency)
+        self.enrichment.on_result = self._broadcast_enrichment
+        self.enrichment.register('IVAC', 'durations', self.device_service.get_duration_updates)
+        self.enrichment.register('DUSTTRAK', 'avg_value', self.device_service.get_avg_data)
+        
+        self.message_queue = deque()
         self.running = True
         
         self.asyncio_loop = None
+        self._messages_available = None
+        self._wakeup_pending = False
         
         self.message_processor_task = None
     
     def set_asyncio_loop(self, loop):
         """Set the asyncio loop reference"""
         self.asyncio_loop = loop
+        if self._messages_available is None:
+            self._messages_available = asyncio.Event()
         if not self.message_processor_task:
             self.message_processor_task = asyncio.create_task(self._process_stream_messages())
+        self.heartbeats.start()
+
+    async def stop(self):
+        """Stop the background tasks, on shutdown"""
+        self.running = False
+        await self.heartbeats.stop()
+        if self.message_processor_task is not None:
+            self.message_processor_task.cancel()
+            await asyncio.gather(self.message_processor_task, return_exceptions=True)
+            self.message_processor_task = None
     
-    def _on_message(self, msg_key: str, msg_value: dict):
-        """Handle messages from dedicated Kafka topic"""
+    def _on_messages(self, records: list):
+        """Handle a batch of (key, value, raw value) messages from the Kafka topics (called from the consumer thread)"""
         try:
-            self.message_queue.put((msg_key, msg_value))
+            received_at = time.perf_counter()
+            self.message_queue.extend(
+                (msg_key, msg_value, raw_value, received_at) for msg_key, msg_value, raw_value in records
+            )
+            if not self._wakeup_pending:
+                self._wakeup_pending = True
+                self.asyncio_loop.call_soon_threadsafe(self._messages_available.set)
             
         except Exception as e:
-            print(f"Error queuing Kafka message for {msg_key}: {e}")
+            print(f"Error queuing {len(records)} Kafka messages: {e}")
 
     async def handle_connection(self, websocket: WebSocketServerProtocol):
         """Route websocket client to correct endpoint"""
         if not self.asyncio_loop:
             self.set_asyncio_loop(asyncio.get_running_loop())
         
-        path = websocket.request.path
+        url = urlsplit(websocket.request.path)
+        path = url.path
+        params = parse_qs(url.query)
         
         if path == "/ws/devices":
             await self._send_devices_list(websocket) ##this is for dashboard app only
             return
         
-        if not path.startswith("/ws/devices/"):
+        if path == "/ws/stream":
+            device_uuids = self._parse_device_list(params.get("devices", [""])[0])
+            multiplexed = True
+        elif path.startswith("/ws/devices/"):
+            device_uuids = [path.split("/")[3]]
+            multiplexed = False
+        else:
             await self._send_error(websocket, "Invalid endpoint")
             return
         
-        device_uuid = path.split("/")[3]
-        await self._handle_device_connection(websocket, device_uuid)
+        try:
+            options = self._parse_connection_options(params, websocket.subprotocol)
+            last_seqs = self._parse_last_seqs(params.get("last_seq", [""])[0], device_uuids)
+            dataitem_filters = self._parse_dataitem_filters(
+                params.get("include", [None])[0], params.get("exclude", [None])[0], device_uuids
+            )
+        except ValueError as e:
+            await self._send_error(websocket, str(e))
+            return
+        subscription = {
+            "last_seqs": last_seqs,
+            "epoch": params.get("epoch", [None])[0],
+            "dataitem_filters": dataitem_filters
+        }
+        
+        await self._handle_device_connection(websocket, device_uuids, options, multiplexed, subscription)
     
-    async def _handle_device_connection(self, websocket: WebSocketServerProtocol, device_uuid: str):
-        """Handle connection to a specific device"""
+    def _parse_device_list(self, devices) -> list:
+        """Parse a comma separated string or a list of device UUIDs"""
+        if isinstance(devices, str):
+            devices = devices.split(",")
+        return [device_uuid.strip() for device_uuid in devices if device_uuid and device_uuid.strip()]
+    
+    def _parse_connection_options(self, params: dict, subprotocol: str = None) -> dict:
+        """Parse per-connection delivery options from the query string and negotiated subprotocol"""
+        options = {}
+        
+        format_name = params.get("format", [WireFormat.SUBPROTOCOLS.get(subprotocol, WireFormat.JSON)])[0]
+        compact_keys = params.get("keys", [""])[0] == "compact"
+        if format_name != WireFormat.JSON or compact_keys:
+            options["wire_format"] = WireFormat(format_name, compact_keys)
+        
+        overflow_policy = params.get("overflow", [None])[0]
+        if overflow_policy is not None:
+            if overflow_policy not in ConnectionQueue.OVERFLOW_POLICIES:
+                raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+            options["overflow_policy"] = overflow_policy
+        
+        if "queue_size" in params:
+            try:
+                options["max_queue_size"] = int(params["queue_size"][0])
+            except ValueError:
+                raise ValueError("queue_size must be an integer")
+        
+        if "max_rate" in params:
+            options["max_rate"] = self._parse_max_rate(params["max_rate"][0])
+        
+        return options
+    
+    def _parse_last_seqs(self, value, device_uuids: list) -> dict:
+        """
+        Parse the last sequence numbers received by a resuming client, either a mapping,
+        a 'device:seq,device:seq' string or a single number for a single device
+        """
+        if not value:
+            return {}
+        if not isinstance(value, dict):
+            entries = [entry.rpartition(":") for entry in str(value).split(",") if entry.strip()]
+            if len(entries) == 1 and not entries[0][0] and len(device_uuids) == 1:
+                value = {device_uuids[0]: entries[0][2]}
+            else:
+                value = {device_uuid.strip(): seq for device_uuid, _, seq in entries}
         try:
-            await self.connection_manager.add_connection(websocket, device_uuid)
-            await self._initialize_device(device_uuid)
-            await self._send_initial_data(websocket, device_uuid)
+            return {device_uuid: int(seq) for device_uuid, seq in value.items()}
+        except (TypeError, ValueError):
+            raise ValueError("last_seq must map devices to integer sequence numbers")
+    
+    def _parse_dataitem_filters(self, include, exclude, device_uuids: list) -> dict:
+        """
+        Parse the dataitems wanted from each device. include and exclude are lists (or comma
+        separated strings) of dataitem IDs or glob patterns applying to every device, or
+        mappings of device UUIDs to such lists
+        """
+        dataitem_filters = {}
+        for device_uuid in device_uuids:
+            dataitem_filter = DataitemFilter.parse(
+                include.get(device_uuid) if isinstance(include, dict) else include,
+                exclude.get(device_uuid) if isinstance(exclude, dict) else exclude
+            )
+            if dataitem_filter is not None:
+                dataitem_filters[device_uuid] = dataitem_filter
+        return dataitem_filters
+    
+    def _parse_max_rate(self, value) -> float:
+        """Validate a maximum update rate (deliveries per second, 0 for lossless delivery)"""
+        try:
+            max_rate = float(value)
+        except (TypeError, ValueError):
+            raise ValueError("max_rate must be a number")
+        if max_rate < 0:
+            raise ValueError("max_rate must not be negative")
+        return max_rate
+    
+    async def _handle_device_connection(self, websocket: WebSocketServerProtocol, device_uuids: list,
+                                        options: dict = None, multiplexed: bool = False, subscription: dict = None):
+        """Handle connection to a specific device, or to any set of devices if multiplexed"""
+        subscription = subscription or {}
+        device_uuid = None if multiplexed else device_uuids[0]
+        label = device_uuid or "multiplexed stream"
+        try:
+            await self.connection_manager.add_connection(websocket, **(options or {}))
+            wire_format = self.connection_manager.get_wire_format(websocket)
+            if wire_format is not self.connection_manager.default_wire_format:
+                await websocket.send(wire_format.encode_description(), text=wire_format.text)
+            if multiplexed:
+                await self._subscribe_devices(websocket, device_uuids, **subscription)
+            else:
+                await self._subscribe_device(websocket, device_uuid, **subscription)
+            self.heartbeats.register(websocket, lambda: self._send_heartbeat(websocket))
             
             sender_task = asyncio.create_task(self._handle_outgoing_messages(websocket))
             receiver_task = asyncio.create_task(self._handle_incoming_messages(websocket, device_uuid))
@@ -89,31 +242,91 @@ class WebsocketsManager:
                     print(f"Task completed with exception: {task.exception()}")
             
         except Exception as e:
-            print(f"Error in device connection handler for {device_uuid}: {e}")
+            print(f"Error in device connection handler for {label}: {e}")
         finally:
+            self.heartbeats.unregister(websocket)
             await self.connection_manager.remove_connection(websocket)
-            print(f"WebSocket connection closed for device: {device_uuid}")
+            print(f"WebSocket connection closed for {label}")
+    
+    async def _subscribe_device(self, websocket: WebSocketServerProtocol, device_uuid: str,
+                                last_seqs: dict = None, epoch: str = None, dataitem_filters: dict = None):
+        """
+        Subscribe a connection to a device, queueing the device's initial data ahead of its
+        messages. A client resuming from a sequence number also gets the messages it missed.
+        """
+        last_seq = (last_seqs or {}).get(device_uuid)
+        dataitem_filter = (dataitem_filters or {}).get(device_uuid)
+        await self._initialize_device(device_uuid)
+        snapshot_seq = self.connection_manager.replay_buffer.last_sequence(device_uuid)
+        initial_data = await self._initial_data(websocket, device_uuid, dataitem_filter)
+        resumed = await self.connection_manager.subscribe_device(
+            websocket, device_uuid, last_seq, epoch, dataitem_filter, initial_data, snapshot_seq
+        )
+        if resumed:
+            print(f"Replaying {resumed['replayed']} messages for device {device_uuid} from seq {last_seq}")
+    
+    async def _subscribe_devices(self, websocket: WebSocketServerProtocol, device_uuids: list,
+                                 last_seqs: dict = None, epoch: str = None, dataitem_filters: dict = None) -> list:
+        """
+        Subscribe a connection to several devices, reporting failures per device.
+        Devices of other workers are not subscribed, the client is redirected to them instead.
+        """
+        foreign = self.worker_router.group_by_owner(device_uuids)
+        for owner, owner_devices in foreign.items():
+            await self._send(websocket, self.worker_router.redirect_event(owner, owner_devices, websocket.request))
+        
+        async def subscribe(device_uuid: str) -> bool:
+            try:
+                await self._subscribe_device(websocket, device_uuid, last_seqs, epoch, dataitem_filters)
+                return True
+            except Exception as e:
+                await self.connection_manager.unsubscribe_device(websocket, device_uuid)
+                await self._send_error(websocket, f"Failed to subscribe to {device_uuid}: {e}")
+                return False
+
+        # Devices are initialized concurrently, so cold devices cost the slowest ksqlDB round trip, not their sum
+        owned = [device_uuid for device_uuid in device_uuids if self.worker_router.owns(device_uuid)]
+        results = await asyncio.gather(*(subscribe(device_uuid) for device_uuid in owned))
+        return [device_uuid for device_uuid, ok in zip(owned, results) if ok]
 
     async def _initialize_device(self, device_uuid: str):
-        """Initialize device monitoring if not already done"""
+        """
+        Initialize device monitoring if not already done. Connections asking for a device
+        being initialized wait for that initialization instead of starting another one.
+        """
+        self._cancel_release(device_uuid)
+        releasing = self._releasing.get(device_uuid)
+        if releasing is not None:
+            await asyncio.shield(releasing)
+        
         if device_uuid in self.device_assets:
             print(f"Device {device_uuid} already initialized")
             return
         
+        initializing = self._initializing.get(device_uuid)
+        if initializing is None:
+            initializing = self._initializing[device_uuid] = asyncio.create_task(self._start_device(device_uuid))
+            initializing.add_done_callback(lambda _: self._initializing.pop(device_uuid, None))
+        # Shielded so a client leaving does not cancel the initialization for the others
+        await asyncio.shield(initializing)
+    
+    async def _start_device(self, device_uuid: str):
+        """Create the device's asset and stream and start consuming it"""
         try:
-            self.openfactory_app.initialize_asset(device_uuid)
+            asset = await self.openfactory_app.initialize_asset(device_uuid)
             
-            topic = self.stream_service.create_device_stream(device_uuid)
+            topic = await self.stream_service.create_device_stream(device_uuid)
             
             self.topic_subscriber.subscribe_to_kafka_topic(
                 topic=topic,
-                kafka_group_id=f'api_device_stream_group_{device_uuid}',
-                on_message=self._on_message,
-                message_filter=lambda key: key == device_uuid
+                on_message=self._on_messages,
+                key=device_uuid,
+                batch=True,
+                raw=True
             )
             
             self.device_topics[device_uuid] = topic
-            self.device_assets[device_uuid] = True
+            self.device_assets[device_uuid] = asset
             print(f"Successfully initialized monitoring for device {device_uuid}")
             
         except StreamCreationException as e:
@@ -123,46 +336,96 @@ class WebsocketsManager:
             print(f"Unexpected error initializing device {device_uuid}: {e}")
             raise
     
-    async def _send_initial_data(self, websocket: WebSocketServerProtocol, device_uuid: str):
-        """Send initial data to newly connected client"""
+    def _on_device_idle(self, device_uuid: str):
+        """Schedule the release of a device whose last connection left"""
+        if not self.device_idle_ttl:
+            return
+        if device_uuid not in self.device_assets and device_uuid not in self._initializing:
+            return
+        self._cancel_release(device_uuid)
+        self._release_timers[device_uuid] = asyncio.get_running_loop().call_later(
+            self.device_idle_ttl, self._start_release, device_uuid
+        )
+    
+    def _cancel_release(self, device_uuid: str):
+        timer = self._release_timers.pop(device_uuid, None)
+        if timer is not None:
+            timer.cancel()
+    
+    def _start_release(self, device_uuid: str):
+        self._release_timers.pop(device_uuid, None)
+        if device_uuid in self._releasing:
+            return
+        releasing = self._releasing[device_uuid] = asyncio.create_task(self._release_device(device_uuid))
+        releasing.add_done_callback(lambda _: self._releasing.pop(device_uuid, None))
+    
+    async def _release_device(self, device_uuid: str):
+        """Stop consuming a device nobody listened to for device_idle_ttl seconds and drop its stream"""
+        initializing = self._initializing.get(device_uuid)
+        if initializing is not None:
+            await asyncio.wait([initializing])
+        if self.connection_manager.get_connection_count(device_uuid) or device_uuid not in self.device_assets:
+            return
+        
         try:
-            data_items = self.device_service.get_device_dataitems(device_uuid)
-            initial_data = {
+            topic = self.device_topics.pop(device_uuid, None)
+            if topic is not None:
+                self.topic_subscriber.unsubscribe_from_kafka_topic(topic, device_uuid)
+            await self.openfactory_app.close_asset(self.device_assets.pop(device_uuid))
+            self.device_service.invalidate_device(device_uuid)
+            await self.stream_service.drop_device_stream(device_uuid)
+            print(f"Released idle device {device_uuid}")
+        except Exception as e:
+            print(f"Error releasing idle device {device_uuid}: {e}")
+    
+    async def _initial_data(self, websocket: WebSocketServerProtocol, device_uuid: str,
+                            dataitem_filter: DataitemFilter = None) -> Optional[dict]:
+        """Initial data of a device for a client subscribing to it, None (and an error sent) if unavailable"""
+        try:
+            data_items = await self.device_service.get_device_dataitems(device_uuid)
+            if dataitem_filter is not None:
+                data_items = dataitem_filter.apply(data_items)
+            connections = self.connection_manager.device_connections.get(device_uuid, ())
+            return {
                 "event": "connection_established",
                 "device_uuid": device_uuid,
                 "timestamp": time.time(),
                 "data_items": data_items,
-                "connection_count": self.connection_manager.get_connection_count(device_uuid)
+                # Including this connection, which is subscribed once the data is queued
+                "connection_count": len(connections) + (websocket not in connections),
+                "epoch": self.connection_manager.replay_buffer.epoch
             }
-            await websocket.send(json.dumps(initial_data))
-            print(f"Sent initial data to client for device {device_uuid}")
             
         except DeviceNotFoundException as e:
             print(f"Device not found: {e}")
             await self._send_error(websocket, str(e))
         except Exception as e:
-            print(f"Error sending initial data for {device_uuid}: {e}")
+            print(f"Error getting initial data for {device_uuid}: {e}")
             await self._send_error(websocket, f"Failed to get initial data: {e}")
+        return None
 
     async def _handle_outgoing_messages(self, websocket: WebSocketServerProtocol):
-        """Handle outgoing messages to client"""
+        """Handle outgoing messages to client, idle connections get heartbeats from the scheduler"""
         queue = self.connection_manager.get_message_queue(websocket)
         if not queue:
             print("No message queue found for websocket")
             return
+        wire_format = self.connection_manager.get_wire_format(websocket)
         
         try:
             while True:
                 try:
-                    message = await asyncio.wait_for(queue.get(), timeout=1.0)
-                    await websocket.send(message)
-                    
-                except asyncio.TimeoutError:
-                    ping_msg = {
-                        "event": "ping", 
-                        "timestamp": time.time()
-                    }
-                    await websocket.send(json.dumps(ping_msg))
+                    if queue.max_rate:
+                        messages = await queue.get_batch()
+                        await websocket.send(wire_format.encode_batch(messages), text=wire_format.text)
+                        self.heartbeats.touch(websocket)
+                        self._observe_delivery(messages)
+                        await asyncio.sleep(1 / queue.max_rate)
+                    else:
+                        message = await queue.get()
+                        await websocket.send(message.encode(wire_format), text=wire_format.text)
+                        self.heartbeats.touch(websocket)
+                        self._observe_delivery((message,))
                     
                 except ConnectionClosed:
                     print("WebSocket connection closed in outgoing handler")
@@ -171,28 +434,42 @@ class WebsocketsManager:
         except Exception as e:
             print(f"Error in outgoing message handler: {e}")
     
+    def _observe_delivery(self, messages):
+        """Record the Kafka-to-websocket latency of sent messages"""
+        FRAMES_SENT.inc()
+        now = time.perf_counter()
+        for message in messages:
+            if message.received_at is not None:
+                DELIVERY_LATENCY.observe(now - message.received_at)
+    
+    async def _send(self, websocket: WebSocketServerProtocol, message: dict):
+        """Send a message encoded with the connection's wire format"""
+        wire_format = self.connection_manager.get_wire_format(websocket)
+        await websocket.send(wire_format.encode(message), text=wire_format.text)
+        self.heartbeats.touch(websocket)
+    
+    async def _send_heartbeat(self, websocket: WebSocketServerProtocol):
+        await self._send(websocket, {"event": "ping", "timestamp": time.time()})
+    
     async def _handle_incoming_messages(self, websocket: WebSocketServerProtocol, device_uuid: str):
         """Handle incoming messages from client"""
         try:
             while True:
                 try:
-                    raw_message = await asyncio.wait_for(websocket.recv(), timeout=30.0)
+                    raw_message = await websocket.recv()
                     
                     try:
-                        message = json.loads(raw_message)
+                        message = self.connection_manager.get_wire_format(websocket).decode(raw_message)
                         client_message = ClientMessage.from_dict(message)
                         await self._process_client_message(websocket, device_uuid, client_message)
                         
-                    except json.JSONDecodeError as e:
+                    except json_codec.JSONDecodeError as e:
                         print(f"Invalid JSON received from {device_uuid}: {e}")
                         await self._send_error(websocket, f"Invalid JSON: {e}")
                         
                     except Exception as e:
                         print(f"Error parsing client message from {device_uuid}: {e}")
                         await self._send_error(websocket, f"Message parsing error: {e}")
-                
-                except asyncio.TimeoutError:
-                    continue
                     
                 except ConnectionClosed:
                     print(f"WebSocket connection closed in incoming handler for {device_uuid}")
@@ -211,7 +488,47 @@ class WebsocketsManager:
                 await self._send_simulation_mode(websocket, message.params)
                 
             elif message.method == "drop_stream":
-                await self._drop_stream(websocket, device_uuid)
+                target_uuid = message.params.get("device_uuid", device_uuid)
+                if not target_uuid:
+                    await self._send_error(websocket, "Missing device_uuid for drop_stream")
+                elif not await self._redirect_if_foreign(websocket, target_uuid):
+                    await self._drop_stream(websocket, target_uuid)
+                
+            elif message.method == "subscribe":
+                device_uuids = self._parse_device_list(message.params.get("devices", []))
+                try:
+                    last_seqs = self._parse_last_seqs(message.params.get("last_seq"), device_uuids)
+                    dataitem_filters = self._parse_dataitem_filters(
+                        message.params.get("include"), message.params.get("exclude"), device_uuids
+                    )
+                except ValueError as e:
+                    await self._send_error(websocket, str(e))
+                    return
+                subscribed = await self._subscribe_devices(
+                    websocket, device_uuids, last_seqs, message.params.get("epoch"), dataitem_filters
+                )
+                await self._send(websocket, {
+                    "event": "subscribed",
+                    "devices": subscribed,
+                    "epoch": self.connection_manager.replay_buffer.epoch,
+                    "timestamp": time.time()
+                })
+                
+            elif message.method == "unsubscribe":
+                device_uuids = self._parse_device_list(message.params.get("devices", []))
+                for target_uuid in device_uuids:
+                    await self.connection_manager.unsubscribe_device(websocket, target_uuid)
+                await self._send(websocket, {
+                    "event": "unsubscribed",
+                    "devices": device_uuids,
+                    "timestamp": time.time()
+                })
+                
+            elif message.method == "set_delivery":
+                await self._set_delivery(websocket, message.params)
+                
+            elif message.method == "history":
+                await self._send_history(websocket, device_uuid, message.params)
                 
             else:
                 print(f"Unknown method from {device_uuid}: {message.method}")
@@ -225,40 +542,57 @@ class WebsocketsManager:
         """Background task to process messages in async context (stream updates)"""
         while self.running:
             try:
-                if not self.message_queue.empty():
-                    try:
-                        msg_key, msg_value = self.message_queue.get_nowait()
-                        await self._handle_stream_message(msg_key, msg_value)
-                    except Exception as e:
-                        print(f"Error processing queued message: {e}")
+                await self._messages_available.wait()
+                self._messages_available.clear()
+                # Reset before draining so a message appended meanwhile either gets drained
+                # below or schedules a new wakeup
+                self._wakeup_pending = False
                 
-                await asyncio.sleep(0.01)
+                while self.message_queue:
+                    # Handle what was queued so far, then let the senders run before the next batch
+                    for _ in range(len(self.message_queue)):
+                        msg_key, msg_value, raw_value, received_at = self.message_queue.popleft()
+                        try:
+                            await self._handle_stream_message(msg_key, msg_value, received_at, raw_value)
+                        except Exception as e:
+                            print(f"Error processing queued message: {e}")
+                    await asyncio.sleep(0)
                 
             except Exception as e:
                 print(f"Error in message processor: {e}")
                 await asyncio.sleep(1)
     
-    async def _handle_stream_message(self, msg_key: str, msg_value: dict):
-        """Parse and thread messages for device updates"""
+    async def _handle_stream_message(self, msg_key: str, msg_value: dict, received_at: float = None,
+                                     raw_value: bytes = None):
+        """Parse and thread messages for device updates, raw_value being msg_value as received from Kafka"""
         try:
             device_uuid = msg_key
-            
-            if device_uuid == 'IVAC':
-                self.device_service.add_duration_updates(msg_value)
-            elif device_uuid == 'DUSTTRAK':
-                self.device_service.add_avg_data(msg_value)
+            MESSAGES_RECEIVED.labels(device_uuid).inc()
+            self.device_service.update_from_message(device_uuid, msg_value)
+            self.device_service.add_to_history(device_uuid, msg_value)
             
             message = {
                 "asset_uuid": device_uuid,
-                "data": dict(msg_value),
+                "data": msg_value,
                 "timestamp": time.time()
             }
             
-            await self.connection_manager.broadcast_to_device_connections(device_uuid, message)
+            await self.connection_manager.broadcast_to_device_connections(device_uuid, message, received_at, raw_value)
+            self.enrichment.submit(device_uuid, msg_value)
             
         except Exception as e:
             print(f"Error handling message for {msg_key}: {e}")
     
+    async def _broadcast_enrichment(self, device_uuid: str, msg_value: dict, fields: dict):
+        """Send the values derived from a message to the device's connections"""
+        message = {
+            "event": "enrichment",
+            "asset_uuid": device_uuid,
+            "data": {"ID": msg_value.get("ID"), "TIMESTAMP": msg_value.get("TIMESTAMP"), **fields},
+            "timestamp": time.time()
+        }
+        await self.connection_manager.broadcast_to_device_connections(device_uuid, message)
+    
     async def _send_simulation_mode(self, websocket: WebSocketServerProtocol, params: dict):
         """Handle simulation mode request"""
         try:
@@ -278,7 +612,7 @@ class WebsocketsManager:
                 "success": True,
                 "value": args
             }
-            await websocket.send(json.dumps(response))
+            await self._send(websocket, response)
             
         except Exception as e:
             print(f"Error sending simulation mode: {e}")
@@ -288,17 +622,79 @@ class WebsocketsManager:
                 "error": str(e),
                 "timestamp": time.time()
             }
-            await websocket.send(json.dumps(error_response))
+            await self._send(websocket, error_response)
+    
+    async def _set_delivery(self, websocket: WebSocketServerProtocol, params: dict):
+        """Handle delivery mode request (max_rate 0 restores lossless delivery)"""
+        queue = self.connection_manager.get_message_queue(websocket)
+        if not queue:
+            await self._send_error(websocket, "No message queue found for connection")
+            return
+        
+        try:
+            max_rate = self._parse_max_rate(params.get("max_rate", 0))
+        except ValueError as e:
+            await self._send_error(websocket, str(e))
+            return
+        
+        queue.set_max_rate(max_rate)
+        response = {
+            "event": "delivery_updated",
+            "success": True,
+            "max_rate": max_rate,
+            "timestamp": time.time()
+        }
+        await self._send(websocket, response)
+    
+    async def _send_history(self, websocket: WebSocketServerProtocol, device_uuid: str, params: dict):
+        """Handle history request for a time range (epoch seconds), optionally downsampled"""
+        target_uuid = params.get("device_uuid", device_uuid)
+        if not target_uuid:
+            await self._send_error(websocket, "Missing device_uuid for history")
+            return
+        if await self._redirect_if_foreign(websocket, target_uuid):
+            return
+        
+        try:
+            now = time.time()
+            end = float(params["end"]) if params.get("end") is not None else None
+            if params.get("start") is not None:
+                start = float(params["start"])
+            elif params.get("duration") is not None:
+                start = (end if end is not None else now) - float(params["duration"])
+            else:
+                start = None
+            max_points = int(params.get("max_points") or 0)
+        except (TypeError, ValueError):
+            await self._send_error(websocket, "start, end and duration must be numbers and max_points an integer")
+            return
+        
+        dataitems = params.get("dataitems")
+        if isinstance(dataitems, str):
+            dataitems = [dataitems]
+        
+        response = {
+            "event": "history",
+            "device_uuid": target_uuid,
+            "start": start,
+            "end": end,
+            "dataitems": self.device_service.get_history(target_uuid, dataitems, start, end, max_points),
+            "timestamp": now
+        }
+        await self._send(websocket, response)
     
     async def _drop_stream(self, websocket: WebSocketServerProtocol, device_uuid: str):
         """Handle stream drop request"""
+        self._cancel_release(device_uuid)
         try:
-            self.stream_service.drop_device_stream(device_uuid)
+            await self.stream_service.drop_device_stream(device_uuid)
+            self.device_service.invalidate_device(device_uuid)
             
             if device_uuid in self.device_topics:
+                self.topic_subscriber.unsubscribe_from_kafka_topic(self.device_topics[device_uuid], device_uuid)
                 del self.device_topics[device_uuid]
             if device_uuid in self.device_assets:
-                del self.device_assets[device_uuid]
+                await self.openfactory_app.close_asset(self.device_assets.pop(device_uuid))
             
             response = {
                 "event": "stream_dropped", 
@@ -306,7 +702,7 @@ class WebsocketsManager:
                 "device_uuid": device_uuid,
                 "timestamp": time.time()
             }
-            await websocket.send(json.dumps(response))
+            await self._send(websocket, response)
             print(f"Dropped stream for device {device_uuid}")
             
         except StreamCreationException as e:
@@ -316,51 +712,35 @@ class WebsocketsManager:
             print(f"Unexpected error dropping stream for {device_uuid}: {e}")
             await self._send_error(websocket, f"Unexpected error: {e}")
     
+    async def _redirect_if_foreign(self, websocket: WebSocketServerProtocol, device_uuid: str) -> bool:
+        """Send a redirect event if a device belongs to another worker, returns True if so"""
+        if self.worker_router.owns(device_uuid):
+            return False
+        owner = self.worker_router.owner(device_uuid)
+        await self._send(websocket, self.worker_router.redirect_event(owner, [device_uuid], websocket.request))
+        return True
+    
     async def _send_devices_list(self, websocket: WebSocketServerProtocol):
         """Send list of all available devices for demo dashboard"""
         try:
-            devices = self.device_service.get_all_devices()
-            device_list = []
-            
-            for device_uuid in devices:
-                try:
-                    device_info = {
-                        "device_uuid": device_uuid,
-                        "dataitems": self.device_service.get_device_dataitems(device_uuid),
-                        "durations": self.device_service.get_device_stats(device_uuid)
-                    }
-                    device_list.append(device_info)
-                except Exception as e:
-                    print(f"Error getting info for device {device_uuid}: {e}")
+            device_list = await self.device_service.get_devices_snapshot()
             response = {
                 "event": "devices_list",
                 "timestamp": time.time(),
                 "devices": device_list
             }
-            await websocket.send(json.dumps(response))
+            await self._send(websocket, response)
             print(f"Sent devices list with {len(device_list)} devices")
             
-            while True:
-                try:
-                    await asyncio.sleep(30)
-                    ping = {
-                        "event": "ping", 
-                        "timestamp": time.time(),
-                        "active_devices": len(device_list)
-                    }
-                    await websocket.send(json.dumps(ping))
-                    
-                except ConnectionClosed:
-                    print("Devices list connection closed")
-                    break
-                except Exception as e:
-                    print(f"Error sending ping to devices list connection: {e}")
-                    break
+            self.heartbeats.register(websocket, lambda: self._send_heartbeat(websocket))
+            await websocket.wait_closed()
+            print("Devices list connection closed")
                     
         except Exception as e:
             print(f"Error in devices list handler: {e}")
             await self._send_error(websocket, f"Failed to get devices list: {e}")
         finally:
+            self.heartbeats.unregister(websocket)
             try:
                 await websocket.close()
             except:
@@ -374,7 +754,7 @@ class WebsocketsManager:
             "timestamp": time.time()
         }
         try:
-            await websocket.send(json.dumps(error_msg))
+            await self._send(websocket, error_msg)
         except ConnectionClosed:
             print("Cannot send error - connection closed")
         except Exception as e:
@@ -0,0 +1,195 @@
+import json_codec
+from typing import Any, Dict, Iterable, Optional, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+# Short names for the keys repeated in every frame, used when compact keys are negotiated
+KEY_DICTIONARY = {
+    "asset_uuid": "a",
+    "data": "d",
+    "timestamp": "t",
+    "ID": "i",
+    "VALUE": "v",
+    "TIMESTAMP": "s",
+    "durations": "u",
+    "avg_value": "g",
+    "value": "l",
+    "event": "e",
+    "messages": "m",
+    "seq": "q",
+}
+
+
+# {"asset_uuid":"<uuid>","data": opening the stream messages of each device
+_envelope_prefixes: Dict[str, bytes] = {}
+
+
+def splice_stream_message(message: Dict, raw_data: bytes) -> bytes:
+    """
+    JSON of an {"asset_uuid", "data", "timestamp", "seq"} stream message, with the Kafka
+    value as received spliced in as its data instead of encoding the decoded data again
+    """
+    asset_uuid = message["asset_uuid"]
+    prefix = _envelope_prefixes.get(asset_uuid)
+    if prefix is None:
+        prefix = _envelope_prefixes[asset_uuid] = json_codec.dumps({"asset_uuid": asset_uuid})[:-1] + b',"data":'
+    # repr() of a float is its JSON representation
+    return b'%s%s,"timestamp":%r,"seq":%d}' % (prefix, raw_data, message["timestamp"], message["seq"])
+
+
+def _compact_keys(message: Dict) -> Dict:
+    """
+    Rename the keys of a message and of its data record using KEY_DICTIONARY. Other nested
+    maps (data_items, dataitems, durations, ...) are keyed by dataitem IDs or states and kept as is
+    """
+    compacted = {}
+    for key, value in message.items():
+        if key == "data" and isinstance(value, dict):
+            value = _compact_record(value)
+        elif key == "messages" and isinstance(value, list):
+            value = [_compact_keys(item) if isinstance(item, dict) else item for item in value]
+        compacted[KEY_DICTIONARY.get(key, key)] = value
+    return compacted
+
+
+def _compact_record(record: Dict) -> Dict:
+    return {
+        KEY_DICTIONARY.get(key, key): (
+            {KEY_DICTIONARY.get(k, k): v for k, v in value.items()}
+            if key == "avg_value" and isinstance(value, dict) else value
+        )
+        for key, value in record.items()
+    }
+
+
+class WireFormat:
+    """Encoding negotiated by a WebSocket connection"""
+
+    JSON = "json"
+    MSGPACK = "msgpack"
+    CBOR = "cbor"
+
+    # Subprotocol names accepted during the handshake, by format
+    SUBPROTOCOLS = {
+        "ofa.json": JSON,
+        "ofa.msgpack": MSGPACK,
+        "ofa.cbor": CBOR,
+    }
+
+    def __init__(self, name: str = JSON, compact_keys: bool = False):
+        if name not in self.available_formats():
+            raise ValueError(f"Unsupported format: {name}")
+        self.name = name
+        self.compact_keys = compact_keys
+        self.cache_key = (name, compact_keys)
+        # Stream messages of plain JSON frames forward their Kafka value as received when encoding
+        # with the json module, orjson encodes the decoded value faster than it can be spliced
+        self.splices_raw = name == self.JSON and not compact_keys and json_codec.library() == 'json'
+
+    @classmethod
+    def available_formats(cls) -> list:
+        formats = [cls.JSON]
+        if msgpack is not None:
+            formats.append(cls.MSGPACK)
+        if cbor2 is not None:
+            formats.append(cls.CBOR)
+        return formats
+
+    @classmethod
+    def available_subprotocols(cls) -> list:
+        formats = cls.available_formats()
+        return [subprotocol for subprotocol, name in cls.SUBPROTOCOLS.items() if name in formats]
+
+    @classmethod
+    def select_subprotocol(cls, connection, subprotocols) -> Optional[str]:
+        """Handshake hook picking the first format subprotocol offered, clients offering none get JSON"""
+        available = cls.available_subprotocols()
+        return next((subprotocol for subprotocol in subprotocols if subprotocol in available), None)
+
+    @property
+    def binary(self) -> bool:
+        return self.name != self.JSON
+
+    @property
+    def text(self) -> bool:
+        """Whether frames are sent as text frames (JSON is encoded to UTF-8 bytes but sent as text)"""
+        return self.name == self.JSON
+
+    def encode(self, message: Dict) -> bytes:
+        if self.compact_keys:
+            message = _compact_keys(message)
+        if self.name == self.MSGPACK:
+            return msgpack.packb(message, use_bin_type=True)
+        if self.name == self.CBOR:
+            return cbor2.dumps(message)
+        return json_codec.dumps(message)
+
+    def decode(self, data: Union[str, bytes]) -> Dict:
+        """Decode a client frame; text frames are always JSON"""
+        if isinstance(data, str):
+            return json_codec.loads(data)
+        if self.name == self.MSGPACK:
+            return msgpack.unpackb(data, raw=False)
+        if self.name == self.CBOR:
+            return cbor2.loads(data)
+        return json_codec.loads(data)
+
+    def encode_batch(self, messages: Iterable['OutboundMessage']) -> bytes:
+        """Encode several messages as one {"event": "batch"} frame"""
+        if self.binary:
+            return self.encode({"event": "batch", "messages": [message.message for message in messages]})
+
+        # JSON messages are already encoded, splice them into the batch envelope
+        event_key = KEY_DICTIONARY["event"] if self.compact_keys else "event"
+        messages_key = KEY_DICTIONARY["messages"] if self.compact_keys else "messages"
+        return (
+            f'{{"{event_key}":"batch","{messages_key}":['.encode('utf-8')
+            + b','.join(message.encode(self) for message in messages)
+            + b']}'
+        )
+
+    def encode_description(self) -> bytes:
+        """Frame announcing the negotiated format (and key dictionary) to the client, never compacted"""
+        description = {"event": "format", "format": self.name}
+        if self.compact_keys:
+            description["keys"] = KEY_DICTIONARY
+        return WireFormat(self.name).encode(description)
+
+
+class OutboundMessage:
+    """A broadcast message shared by all connections, encoded at most once per format"""
+
+    __slots__ = ("message", "received_at", "raw_data", "_encoded")
+
+    def __init__(self, message: Dict, received_at: float = None, raw_data: bytes = None):
+        self.message = message
+        # time.perf_counter() when the message was received from Kafka, None if not measured
+        self.received_at = received_at
+        # Kafka value of a stream message's data, forwarded as is in plain JSON frames
+        self.raw_data = raw_data
+        self._encoded = {}
+
+    def replay(self) -> 'OutboundMessage':
+        """Copy for a replay, sharing the encodings but not counted in delivery latency"""
+        replayed = OutboundMessage(self.message, raw_data=self.raw_data)
+        replayed._encoded = self._encoded
+        return replayed
+
+    def encode(self, wire_format: WireFormat) -> bytes:
+        encoded = self._encoded.get(wire_format.cache_key)
+        if encoded is None:
+            if self.raw_data is not None and wire_format.splices_raw:
+                encoded = splice_stream_message(self.message, self.raw_data)
+            else:
+                encoded = wire_format.encode(self.message)
+            self._encoded[wire_format.cache_key] = encoded
+        return encoded
@@ -0,0 +1,96 @@
+from http import HTTPStatus
+from typing import Dict, Iterable, List
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from kafka.partitioner.default import murmur2
+
+
+class WorkerRouter:
+    """
+    Assigns each device to one of the API worker processes.
+
+    A device belongs to the worker owning its partition of the shared stream, computed like
+    the Kafka default partitioner, so a worker only consumes the partitions of its devices.
+    Every worker listens on the shared port and on its own port (websocket_port + 1 + index),
+    to which clients are redirected for devices of other workers.
+    """
+
+    # Query parameters specific to a set of devices, not carried over in redirects
+    DEVICE_PARAMS = ("devices", "last_seq")
+
+    def __init__(self, workers: int = 1, index: int = 0, partitions: int = 6,
+                 base_port: int = 8000, public_host: str = ""):
+        self.workers = max(workers, 1)
+        self.index = index
+        self.partitions = partitions
+        self.base_port = base_port
+        self.public_host = public_host
+        self._owners: Dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 1
+
+    @property
+    def port(self) -> int:
+        """Port on which only this worker listens"""
+        return self.worker_port(self.index)
+
+    def worker_port(self, index: int) -> int:
+        return self.base_port + 1 + index
+
+    def partition_for(self, device_uuid: str) -> int:
+        """Partition of a device's records in the shared stream (keyed by ASSET_UUID)"""
+        return (murmur2(device_uuid.encode('utf-8')) & 0x7fffffff) % self.partitions
+
+    def owned_partitions(self) -> List[int]:
+        return [partition for partition in range(self.partitions) if partition % self.workers == self.index]
+
+    def owner(self, device_uuid: str) -> int:
+        owner = self._owners.get(device_uuid)
+        if owner is None:
+            owner = self._owners[device_uuid] = self.partition_for(device_uuid) % self.workers
+        return owner
+
+    def owns(self, device_uuid: str) -> bool:
+        return not self.enabled or self.owner(device_uuid) == self.index
+
+    def worker_url(self, index: int, request, path: str = None) -> str:
+        """URL of a worker's own port, keeping the host, path and options of a request"""
+        host = self.public_host or request.headers.get("Host", "localhost").rsplit(":", 1)[0]
+        url = urlsplit(request.path)
+        params = {
+            name: values for name, values in parse_qs(url.query).items()
+            if path is None or name not in self.DEVICE_PARAMS
+        }
+        query = urlencode(params, doseq=True)
+        return f"ws://{host}:{self.worker_port(index)}{path or url.path}" + (f"?{query}" if query else "")
+
+    def group_by_owner(self, device_uuids: Iterable[str]) -> Dict[int, List[str]]:
+        """Group the devices not owned by this worker by owning worker"""
+        foreign: Dict[int, List[str]] = {}
+        for device_uuid in device_uuids:
+            if not self.owns(device_uuid):
+                foreign.setdefault(self.owner(device_uuid), []).append(device_uuid)
+        return foreign
+
+    def process_request(self, connection, request):
+        """Handshake hook redirecting single device connections to the owning worker"""
+        path = urlsplit(request.path).path
+        if not self.enabled or not path.startswith("/ws/devices/"):
+            return None
+        device_uuid = path.split("/")[3]
+        if self.owns(device_uuid):
+            return None
+
+        response = connection.respond(HTTPStatus.TEMPORARY_REDIRECT, f"Device {device_uuid} is served by another worker\n")
+        response.headers["Location"] = self.worker_url(self.owner(device_uuid), request)
+        return response
+
+    def redirect_event(self, index: int, device_uuids: List[str], request) -> dict:
+        """Event telling a multiplexed client where to subscribe to devices of another worker"""
+        return {
+            "event": "redirect",
+            "devices": device_uuids,
+            "url": self.worker_url(index, request, "/ws/stream")
+        }
@@ -8,4 +8,8 @@ class DeviceNotFoundException(APIException):
 
 class StreamCreationException(APIException):
     """Raised when stream creation fails"""
+    pass
+
+class KSQLDBTimeoutException(APIException):
+    """Raised when ksqlDB does not answer in time"""
     pass
\ No newline at end of file
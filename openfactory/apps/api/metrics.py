@@ -0,0 +1,79 @@
+from http import HTTPStatus
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Registry of the API metrics, served on /metrics by every worker
+REGISTRY = CollectorRegistry()
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+MESSAGES_RECEIVED = Counter(
+    'ofa_api_messages_received', 'Stream messages received from Kafka', ['device'], registry=REGISTRY
+)
+FRAMES_SENT = Counter(
+    'ofa_api_frames_sent', 'Frames sent to websocket clients', registry=REGISTRY
+)
+KAFKA_RECORD_AGE = Histogram(
+    'ofa_api_kafka_record_age_seconds', 'Age of Kafka records (from their timestamp) when consumed',
+    buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+DELIVERY_LATENCY = Histogram(
+    'ofa_api_delivery_latency_seconds', 'Time from Kafka reception to the websocket send of a message',
+    buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+KSQLDB_QUERY_LATENCY = Histogram(
+    'ofa_api_ksqldb_query_seconds', 'ksqlDB query and statement latency', ['operation'],
+    buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+CONSUMER_LAG = Gauge(
+    'ofa_api_kafka_consumer_lag', 'Records not yet consumed, by topic', ['topic'], registry=REGISTRY
+)
+
+
+class ConnectionCollector:
+    """Reads connection and queue state from the ConnectionManager when metrics are scraped"""
+
+    def __init__(self, connection_manager):
+        self.connection_manager = connection_manager
+
+    def collect(self):
+        queues = list(self.connection_manager.message_queues.items())
+
+        connections = GaugeMetricFamily('ofa_api_connections', 'Open device websocket connections')
+        connections.add_metric([], len(queues))
+        yield connections
+
+        depth = GaugeMetricFamily(
+            'ofa_api_connection_queue_depth', 'Messages waiting to be sent, by connection', labels=['connection']
+        )
+        for websocket, queue in queues:
+            depth.add_metric([self._connection_label(websocket)], queue.qsize())
+        yield depth
+
+        stats = self.connection_manager.overflow_stats
+        for name, key, documentation in (
+            ('ofa_api_messages_dropped', 'dropped', 'Messages dropped from full connection queues'),
+            ('ofa_api_messages_conflated', 'conflated', 'Messages replaced by a newer value before being sent'),
+            ('ofa_api_slow_consumers_disconnected', 'disconnected', 'Connections closed for a full queue'),
+        ):
+            counter = CounterMetricFamily(name, documentation)
+            counter.add_metric([], stats.get(key, 0))
+            yield counter
+
+    def _connection_label(self, websocket) -> str:
+        remote_address = getattr(websocket, 'remote_address', None)
+        if remote_address:
+            return f"{remote_address[0]}:{remote_address[1]}"
+        return str(id(websocket))
+
+
+def register_connection_manager(connection_manager):
+    REGISTRY.register(ConnectionCollector(connection_manager))
+
+
+def metrics_response(connection):
+    """HTTP response with the metrics, for the websocket server's process_request hook"""
+    response = connection.respond(HTTPStatus.OK, generate_latest(REGISTRY).decode('utf-8'))
+    del response.headers['Content-Type']
+    response.headers['Content-Type'] = CONTENT_TYPE_LATEST
+    return response
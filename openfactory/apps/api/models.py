@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from typing import Dict, Any
-import json
+import json_codec
 
 @dataclass
 class DeviceMessage:
@@ -10,7 +10,7 @@ class DeviceMessage:
     timestamp: float
 
     def to_json(self) -> str:
-        return json.dumps({
+        return json_codec.dumps_str({
             "device_uuid": self.device_uuid,
             "event": self.event_type,
             "data": self.data,
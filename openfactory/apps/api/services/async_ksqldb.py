@@ -0,0 +1,40 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from exceptions import KSQLDBTimeoutException
+
+
+class AsyncKSQLDBClient:
+    """
+    Runs the calls of the synchronous KSQLDBClient in a bounded thread pool, so a slow
+    ksqlDB never blocks the event loop serving the websockets.
+
+    A call that times out is abandoned by its caller but keeps its thread until ksqlDB
+    answers, at most max_workers calls are in flight and the others wait for a thread.
+    """
+
+    def __init__(self, ksql_client, max_workers: int = 4, timeout: float = 10):
+        self.ksql_client = ksql_client
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ksqldb")
+
+    async def query(self, query: str, timeout: float = None):
+        """Run a pull query, returning its DataFrame"""
+        return await self.run(self.ksql_client.query, query, timeout=timeout)
+
+    async def statement_query(self, statement: str, timeout: float = None):
+        """Run a statement (CREATE, DROP, ...)"""
+        return await self.run(self.ksql_client.statement_query, statement, timeout=timeout)
+
+    async def run(self, function: Callable, *args, timeout: float = None) -> Any:
+        """Run any blocking call talking to ksqlDB in the pool, within timeout seconds"""
+        timeout = self.timeout if timeout is None else timeout
+        future = asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise KSQLDBTimeoutException(f"ksqlDB did not answer within {timeout} s")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,33 @@
+import time
+from typing import Any, Dict, Hashable, Tuple
+
+
+class TTLCache:
+    """Small in-memory cache whose entries expire after a fixed time-to-live"""
+
+    MISSING = object()
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+
+    def get(self, key: Hashable) -> Any:
+        """Return the cached value, or TTLCache.MISSING if absent or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return self.MISSING
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return self.MISSING
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.ttl > 0:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -1,74 +1,218 @@
-from typing import List
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Tuple
+
+from metrics import KSQLDB_QUERY_LATENCY
+from services.async_ksqldb import AsyncKSQLDBClient
+from services.cache import TTLCache
+from services.history import HistoryStore
+from services.moving_average import MovingAverageEngine
+from services.power_duration_aggregator import PowerDurationAggregator
 
 class DeviceService:
-    """Handles device-related business logic""" 
+    """Handles device-related business logic"""
+
+    SEED_RETRY_INTERVAL = 60
 
-    def __init__(self, ksql_client):
+    def __init__(self, ksql_client: AsyncKSQLDBClient, cache_ttl: float = 30,
+                 moving_average_windows: Dict[str, Tuple[int, int]] = None,
+                 history_max_samples: int = 1000, history_max_age: float = 3600,
+                 power_durations_refresh: float = 0):
         self.ksqlClient = ksql_client
+        self.cache = TTLCache(cache_ttl)
+        self.power_durations = PowerDurationAggregator()
+        self.moving_averages = MovingAverageEngine(moving_average_windows or {})
+        self.history = HistoryStore(history_max_samples, history_max_age)
+        # Reload the power totals from ksqlDB every power_durations_refresh seconds instead of
+        # seeding them once, for an API worker not receiving the IVAC events itself
+        self.power_durations_refresh = power_durations_refresh
+        self._next_seed_attempt = 0
+        self._seed_task = None
+        # Lookups in flight by cache key, awaited by every caller missing the same key
+        self._loading: Dict[Hashable, asyncio.Task] = {}
+
+    async def _load(self, key: Hashable, load: Callable[[], Awaitable]):
+        """Run load() once for all the callers missing a cache key at the same time"""
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.create_task(load())
+
+            def forget(_):
+                if self._loading.get(key) is task:
+                    del self._loading[key]
+            task.add_done_callback(forget)
+        # Shielded so a caller leaving does not cancel the lookup for the others
+        return await asyncio.shield(task)
 
-    def get_all_devices(self) -> List[str]:
+    async def get_all_devices(self) -> List[str]:
         """Get all devices from the database."""
+        cached = self.cache.get(('devices',))
+        if cached is not TTLCache.MISSING:
+            return list(cached)
+        return list(await self._load(('devices',), self._fetch_all_devices))
+
+    async def _fetch_all_devices(self) -> List[str]:
         devices = []
         try:
             query = "SELECT ASSET_UUID FROM assets_type WHERE TYPE LIKE '%Agent';"
-            df = self.ksqlClient.query(query)
+            with KSQLDB_QUERY_LATENCY.labels('get_all_devices').time():
+                df = await self.ksqlClient.query(query)
             for asset in df.ASSET_UUID.tolist():
                 devices.append(asset[:-6])  # Remove the '-Agent' suffix
+            self.cache.set(('devices',), list(devices))
             return devices
         except Exception as e:
             print(f"Error getting devices: {e}")
             return devices
 
-    def get_device_dataitems(self, device_uuid: str) -> dict:
+    async def get_device_dataitems(self, device_uuid: str) -> dict:
+        cached = self.cache.get(('dataitems', device_uuid))
+        if cached is not TTLCache.MISSING:
+            return dict(cached)
+        return dict(await self._load(('dataitems', device_uuid), lambda: self._fetch_device_dataitems(device_uuid)))
+
+    async def _fetch_device_dataitems(self, device_uuid: str) -> dict:
         try:
             query = (
                 f"SELECT ID, VALUE FROM assets WHERE ASSET_UUID = '{device_uuid}' "
                 f"AND TYPE IN ('Events', 'Condition') AND VALUE != 'UNAVAILABLE';"
             )
-            df = self.ksqlClient.query(query)
-            return dict(zip(df.ID.tolist(), df.VALUE.tolist())) if 'ID' in df.columns and 'VALUE' in df.columns else {}
+            with KSQLDB_QUERY_LATENCY.labels('get_device_dataitems').time():
+                df = await self.ksqlClient.query(query)
+            dataitems = dict(zip(df.ID.tolist(), df.VALUE.tolist())) if 'ID' in df.columns and 'VALUE' in df.columns else {}
+            self.cache.set(('dataitems', device_uuid), dict(dataitems))
+            return dataitems
         except Exception as e:
             print(f"Error getting device dataitems for {device_uuid}: {e}")
             return {}
 
+    async def get_devices_snapshot(self) -> List[dict]:
+        """Get the latest dataitem values and durations of all devices in a constant number of queries"""
+        devices = await self.get_all_devices()
+        dataitems_by_device = {}
+        for device_uuid in devices:
+            cached = self.cache.get(('dataitems', device_uuid))
+            if cached is not TTLCache.MISSING:
+                dataitems_by_device[device_uuid] = dict(cached)
+
+        missing = [device_uuid for device_uuid in devices if device_uuid not in dataitems_by_device]
+        if missing:
+            try:
+                query = (
+                    "SELECT ASSET_UUID, ID, VALUE FROM assets "
+                    "WHERE TYPE IN ('Events', 'Condition') AND VALUE != 'UNAVAILABLE';"
+                )
+                with KSQLDB_QUERY_LATENCY.labels('get_devices_snapshot').time():
+                    df = await self.ksqlClient.query(query)
+                fetched = {device_uuid: {} for device_uuid in missing}
+                if 'ASSET_UUID' in df.columns and 'ID' in df.columns and 'VALUE' in df.columns:
+                    for asset_uuid, dataitem_id, value in zip(df.ASSET_UUID.tolist(), df.ID.tolist(), df.VALUE.tolist()):
+                        if asset_uuid in fetched:
+                            fetched[asset_uuid][dataitem_id] = value
+                for device_uuid, dataitems in fetched.items():
+                    self.cache.set(('dataitems', device_uuid), dict(dataitems))
+                    dataitems_by_device[device_uuid] = dataitems
+            except Exception as e:
+                print(f"Error getting devices snapshot: {e}")
+
+        # The first snapshot waits for the power durations, later ones use the current totals
+        self._seed_power_durations()
+        if not self.power_durations.seeded and self._seed_task is not None:
+            await asyncio.shield(self._seed_task)
+
+        return [
+            {
+                "device_uuid": device_uuid,
+                "dataitems": dataitems_by_device.get(device_uuid, {}),
+                "durations": self.get_device_stats(device_uuid)
+            }
+            for device_uuid in devices
+        ]
+
     def get_device_stats(self, dataitem_id) -> dict:
+        return self.power_durations.get_durations(dataitem_id)
+
+    def _seed_power_durations(self):
+        """
+        Seed the power duration totals from ksqlDB in the background (from the event loop),
+        once or every power_durations_refresh seconds, retrying periodically on failure
+        """
+        if self._seed_task is not None and not self._seed_task.done():
+            return
+        if time.monotonic() < self._next_seed_attempt:
+            return
+        if self.power_durations.seeded and not self.power_durations_refresh:
+            return
+        self._seed_task = asyncio.create_task(self._seed())
+
+    async def _seed(self):
         try:
-            query = (
-                f"SELECT IVAC_POWER_KEY, TOTAL_DURATION_SEC FROM IVAC_POWER_STATE_TOTALS "
-                f"WHERE IVAC_POWER_KEY LIKE '{dataitem_id}%';"
-            )
-            df = self.ksqlClient.query(query)
-            return dict(zip(df.IVAC_POWER_KEY.str[11:].tolist(), df.TOTAL_DURATION_SEC.tolist())) if 'IVAC_POWER_KEY' in df.columns and 'TOTAL_DURATION_SEC' in df.columns else {}
-        except Exception as  e:
-            print(f"Error getting dataitems stats:{e}")
-            return {}
-        
-    def add_duration_updates(self, msg_value: dict):
-        """Add duration data for IVAC device"""
+            with KSQLDB_QUERY_LATENCY.labels('seed_power_durations').time():
+                if self.power_durations.seeded:
+                    power_durations = PowerDurationAggregator()
+                    await power_durations.seed(self.ksqlClient)
+                    self.power_durations = power_durations
+                else:
+                    await self.power_durations.seed(self.ksqlClient)
+            self._next_seed_attempt = time.monotonic() + self.power_durations_refresh
+        except Exception as e:
+            self._next_seed_attempt = time.monotonic() + self.SEED_RETRY_INTERVAL
+            print(f"Error seeding power durations: {e}")
+
+    def invalidate_device(self, device_uuid: str):
+        """Drop cached lookups for a device"""
+        self.cache.invalidate(('dataitems', device_uuid))
+        # A lookup in flight may have started before the change, the next caller starts a new one
+        self._loading.pop(('dataitems', device_uuid), None)
+        if device_uuid == self.power_durations.device_uuid:
+            # The totals miss the events of a device no longer consumed, reseed them when it comes back
+            self.power_durations = PowerDurationAggregator()
+            self._next_seed_attempt = 0
+
+    def update_from_message(self, device_uuid: str, msg_value: dict):
+        """Refresh cached dataitem values from a live stream message"""
+        dataitems = self.cache.get(('dataitems', device_uuid))
+        if dataitems is TTLCache.MISSING:
+            return
+        # Only dataitems already cached are Events/Condition, Samples are left out
+        if msg_value.get('ID') in dataitems:
+            dataitems[msg_value['ID']] = msg_value.get('VALUE')
+
+    def add_to_history(self, device_uuid: str, msg_value: dict):
+        """Keep a live stream sample in the device's history"""
         try:
-            query = (
-                f"SELECT IVAC_POWER_KEY, TOTAL_DURATION_SEC FROM IVAC_POWER_STATE_TOTALS "
-                f"WHERE IVAC_POWER_KEY LIKE '{msg_value['ID']}%';"
-            )
-            df = self.ksqlClient.query(query)
-            msg_value['durations'] = dict(zip(df.IVAC_POWER_KEY.str[11:].tolist(), df.TOTAL_DURATION_SEC.tolist())) if 'IVAC_POWER_KEY' in df.columns and 'TOTAL_DURATION_SEC' in df.columns else {}
+            self.history.add(device_uuid, msg_value['ID'], msg_value.get('VALUE'), msg_value['TIMESTAMP'])
+        except Exception as e:
+            print(f"Error adding history sample for {device_uuid}: {e}")
+
+    def get_history(self, device_uuid: str, dataitem_ids: List[str] = None, start: float = None,
+                    end: float = None, max_points: int = 0) -> Dict[str, list]:
+        """Get [timestamp, value] samples of a device between start and end (epoch seconds)"""
+        start_ms = None if start is None else int(start * 1000)
+        end_ms = None if end is None else int(end * 1000)
+        history = self.history.query(device_uuid, dataitem_ids, start_ms, end_ms, max_points)
+        return {
+            dataitem_id: [[ts_ms / 1000, value] for ts_ms, value in samples]
+            for dataitem_id, samples in history.items()
+        }
+
+    def get_duration_updates(self, msg_value: dict) -> dict:
+        """Duration data for an IVAC message"""
+        try:
+            self._seed_power_durations()
+            self.power_durations.update(msg_value['ID'], msg_value['VALUE'], msg_value['TIMESTAMP'])
+            return {'durations': self.power_durations.get_durations(msg_value['ID'])}
         except Exception as e:
             print(f"Error adding duration updates for {msg_value['ID']}: {e}")
+            return {}
 
-    def add_avg_data(self, msg_value: dict):
-        """Add average data for DUSTTRAK device"""
+    def get_avg_data(self, msg_value: dict) -> dict:
+        """Average data for a DUSTTRAK message"""
         try:
-            query = (
-                f"SELECT AVERAGE_VALUE, TIMESTAMP FROM {msg_value['ID']}_moving_average "
-                f"WHERE timestamp LIKE '{msg_value['TIMESTAMP'][:-10]}%';"
+            avg_value = self.moving_averages.add(
+                'DUSTTRAK', msg_value['ID'], msg_value['VALUE'], msg_value['TIMESTAMP']
             )
-            df = self.ksqlClient.query(query)
-            if 'AVERAGE_VALUE' in df.columns and 'TIMESTAMP' in df.columns and not df['AVERAGE_VALUE'].empty and not df['TIMESTAMP'].empty:
-                msg_value['avg_value'] = {
-                    'value': df['AVERAGE_VALUE'].tolist()[0],
-                    'timestamp': df['TIMESTAMP'].tolist()[0]
-                }
-            else:
-                msg_value['avg_value'] = {}
+            return {'avg_value': avg_value} if avg_value else {}
         except Exception as e:
-            print(f"Error adding avg values for {msg_value['ID']}: {e}")
\ No newline at end of file
+            print(f"Error adding avg values for {msg_value['ID']}: {e}")
+            return {}
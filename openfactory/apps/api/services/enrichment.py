@@ -0,0 +1,71 @@
+import asyncio
+import inspect
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+# Returns the fields to add to a message (None or {} for none), directly or awaited
+EnrichmentStage = Callable[[dict], Any]
+
+
+class EnrichmentPipeline:
+    """
+    Computes the values derived from device messages (power durations, moving averages, ...)
+    after the raw messages are broadcast, so their cost never delays the raw data.
+
+    The messages of a device go through its stages in order, as the stages keep state across
+    messages. Devices are enriched concurrently, with at most max_concurrency stages running
+    at once. The fields produced for a message are handed to on_result.
+    """
+
+    def __init__(self, max_concurrency: int = 4):
+        self._stages: Dict[str, Dict[str, EnrichmentStage]] = {}
+        # Immutable snapshot of each device's stages, rebuilt only on registration
+        self._routes: Dict[str, Tuple[Tuple[str, EnrichmentStage], ...]] = {}
+        self._pending: Dict[str, Deque[dict]] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+        self.on_result: Optional[Callable[[str, dict, dict], Awaitable[None]]] = None
+
+    def register(self, device_uuid: str, name: str, stage: EnrichmentStage):
+        """Add a stage for a device, replacing the device's stage of the same name"""
+        self._stages.setdefault(device_uuid, {})[name] = stage
+        self._routes[device_uuid] = tuple(self._stages[device_uuid].items())
+
+    def submit(self, device_uuid: str, msg_value: dict) -> bool:
+        """Queue a message for enrichment (from the event loop), returns False if the device has no stage"""
+        if device_uuid not in self._routes:
+            return False
+        pending = self._pending.get(device_uuid)
+        if pending is None:
+            pending = self._pending[device_uuid] = deque()
+        pending.append(msg_value)
+        if device_uuid not in self._workers:
+            self._workers[device_uuid] = asyncio.create_task(self._enrich_device(device_uuid, pending))
+        return True
+
+    async def _enrich_device(self, device_uuid: str, pending: Deque[dict]):
+        try:
+            while pending:
+                msg_value = pending.popleft()
+                fields = {}
+                for name, stage in self._routes.get(device_uuid, ()):
+                    try:
+                        async with self._semaphore:
+                            result = stage(msg_value)
+                            if inspect.isawaitable(result):
+                                result = await result
+                        if result:
+                            fields.update(result)
+                    except Exception as e:
+                        print(f"Error in enrichment stage {name} for {device_uuid}: {e}")
+                if fields and self.on_result is not None:
+                    try:
+                        await self.on_result(device_uuid, msg_value, fields)
+                    except Exception as e:
+                        print(f"Error delivering enrichment for {device_uuid}: {e}")
+                # Let the raw messages through between enrichments
+                await asyncio.sleep(0)
+        finally:
+            self._workers.pop(device_uuid, None)
+            if not pending:
+                self._pending.pop(device_uuid, None)
@@ -0,0 +1,144 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Tuple
+
+from services.timestamps import stream_timestamp_to_epoch_ms
+
+
+class SeriesHistory:
+    """
+    Ring buffer of the latest samples of one dataitem, kept in preallocated arrays.
+
+    Values are stored as doubles as long as they are numeric; the first non-numeric value
+    switches the series to a plain list.
+    """
+
+    def __init__(self, capacity: int, max_age_ms: int = 0):
+        self.capacity = capacity
+        self.max_age_ms = max_age_ms
+        self._timestamps = array('q', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _position(self, index: int) -> int:
+        return (self._start + index) % self.capacity
+
+    def timestamp_at(self, index: int) -> int:
+        return self._timestamps[self._position(index)]
+
+    def add(self, ts_ms: int, value) -> bool:
+        """Add a sample, returning False if it is older than the newest one and was ignored"""
+        if self._count and ts_ms < self.timestamp_at(self._count - 1):
+            return False
+
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            if isinstance(self._values, array):
+                self._values = list(self._values)
+
+        if self._count == self.capacity:
+            self._start = self._position(1)
+            self._count -= 1
+        position = self._position(self._count)
+        self._timestamps[position] = ts_ms
+        self._values[position] = value
+        self._count += 1
+
+        if self.max_age_ms:
+            oldest = ts_ms - self.max_age_ms
+            while self._count and self._timestamps[self._start] < oldest:
+                self._start = self._position(1)
+                self._count -= 1
+        return True
+
+    def _index(self, ts_ms: int, side=bisect_left) -> int:
+        """Logical index of a timestamp, with the same semantics as bisect"""
+        # Search the two sorted runs of the ring separately
+        first_run = min(self._count, self.capacity - self._start)
+        if first_run and ts_ms <= self._timestamps[self._start + first_run - 1]:
+            return side(self._timestamps, ts_ms, self._start, self._start + first_run) - self._start
+        return first_run + side(self._timestamps, ts_ms, 0, self._count - first_run)
+
+    def range(self, start_ms: Optional[int] = None, end_ms: Optional[int] = None) -> List[Tuple[int, object]]:
+        """Get the (timestamp ms, value) samples between start_ms and end_ms included, oldest first"""
+        first = 0 if start_ms is None else self._index(start_ms)
+        last = self._count if end_ms is None else self._index(end_ms, bisect_right)
+        samples = []
+        for index in range(first, last):
+            position = self._position(index)
+            samples.append((self._timestamps[position], self._values[position]))
+        return samples
+
+
+def downsample(samples: List[Tuple[int, object]], max_points: int) -> List[Tuple[int, object]]:
+    """
+    Reduce samples to at most max_points, one per equal time bucket: the average of
+    numeric values, or the last value of the bucket otherwise.
+    """
+    if max_points <= 0 or len(samples) <= max_points:
+        return samples
+
+    first_ts = samples[0][0]
+    width = (samples[-1][0] - first_ts) / max_points or 1
+    buckets = []
+    current = None
+    for ts_ms, value in samples:
+        bucket = min(int((ts_ms - first_ts) / width), max_points - 1)
+        if current is None or current[0] != bucket:
+            current = [bucket, ts_ms, value, 0.0, 0]
+            buckets.append(current)
+        current[1] = ts_ms
+        current[2] = value
+        if isinstance(value, float):
+            current[3] += value
+            current[4] += 1
+    return [
+        (last_ts, total / count if count else last_value)
+        for _, last_ts, last_value, total, count in buckets
+    ]
+
+
+class HistoryStore:
+    """Recent samples of every (device, dataitem) seen on the streams"""
+
+    def __init__(self, max_samples: int = 1000, max_age: float = 3600):
+        """
+        Args:
+            max_samples: Samples kept per dataitem
+            max_age: Seconds of history kept per dataitem (0 keeps max_samples regardless of age)
+        """
+        self.max_samples = max_samples
+        self.max_age_ms = int(max_age * 1000)
+        self._series: Dict[str, Dict[str, SeriesHistory]] = {}
+
+    def add(self, device_uuid: str, dataitem_id: str, value, timestamp: str):
+        """Add a sample with its stream timestamp"""
+        if not self.max_samples:
+            return
+        device_series = self._series.get(device_uuid)
+        if device_series is None:
+            device_series = self._series[device_uuid] = {}
+        series = device_series.get(dataitem_id)
+        if series is None:
+            series = device_series[dataitem_id] = SeriesHistory(self.max_samples, self.max_age_ms)
+        series.add(stream_timestamp_to_epoch_ms(timestamp), value)
+
+    def get_dataitems(self, device_uuid: str) -> List[str]:
+        return list(self._series.get(device_uuid, {}))
+
+    def query(self, device_uuid: str, dataitem_ids: List[str] = None, start_ms: Optional[int] = None,
+              end_ms: Optional[int] = None, max_points: int = 0) -> Dict[str, List[Tuple[int, object]]]:
+        """Get the samples of a device's dataitems (all if not given) within a time range"""
+        device_series = self._series.get(device_uuid, {})
+        if dataitem_ids is None:
+            dataitem_ids = list(device_series)
+        return {
+            dataitem_id: downsample(device_series[dataitem_id].range(start_ms, end_ms), max_points)
+            for dataitem_id in dataitem_ids
+            if dataitem_id in device_series
+        }
@@ -0,0 +1,108 @@
+from collections import deque
+from datetime import datetime
+from math import gcd
+from typing import Deque, Dict, List, Optional, Tuple
+
+from services.timestamps import STREAM_TIMEZONE, format_stream_timestamp, stream_timestamp_to_epoch_ms
+
+
+class HoppingWindowAverage:
+    """
+    Hopping-window average of a single series, like WINDOW HOPPING in moving_average.sql.
+
+    Samples are summed into buckets of gcd(size, advance) width, so each update only
+    touches the size / width buckets of one window.
+    """
+
+    def __init__(self, size_ms: int, advance_ms: int):
+        self.size_ms = size_ms
+        self.advance_ms = advance_ms
+        self.bucket_ms = gcd(size_ms, advance_ms)
+        # [bucket index, sum, count], ordered by bucket index
+        self._buckets: Deque[List] = deque()
+
+    def _window_start(self, ts_ms: int) -> int:
+        """Start of the earliest-ending window containing ts_ms"""
+        return ((ts_ms - self.size_ms) // self.advance_ms + 1) * self.advance_ms
+
+    def add(self, ts_ms: int, value: float) -> Optional[Tuple[float, int]]:
+        """
+        Add a sample and return (average, window end in epoch ms) of the earliest-ending
+        window containing it, or None if the sample is older than the retained windows.
+        """
+        index = ts_ms // self.bucket_ms
+        window_start = self._window_start(ts_ms)
+        window_end = window_start + self.size_ms
+        first_index = window_start // self.bucket_ms
+
+        # Buckets before the newest sample's window are evicted, so a window starting
+        # there can no longer be averaged
+        if self._buckets and first_index < self._window_start(self._buckets[-1][0] * self.bucket_ms) // self.bucket_ms:
+            return None
+
+        if not self._buckets or index > self._buckets[-1][0]:
+            self._buckets.append([index, value, 1])
+        elif index < self._buckets[0][0]:
+            self._buckets.appendleft([index, value, 1])
+        else:
+            for bucket in reversed(self._buckets):
+                if bucket[0] == index:
+                    bucket[1] += value
+                    bucket[2] += 1
+                    break
+                if bucket[0] < index:
+                    position = self._buckets.index(bucket) + 1
+                    self._buckets.insert(position, [index, value, 1])
+                    break
+
+        newest_start = self._window_start(self._buckets[-1][0] * self.bucket_ms)
+        while self._buckets[0][0] < newest_start // self.bucket_ms:
+            self._buckets.popleft()
+
+        last_index = window_end // self.bucket_ms
+        total = 0.0
+        count = 0
+        for bucket_index, bucket_sum, bucket_count in self._buckets:
+            if first_index <= bucket_index < last_index:
+                total += bucket_sum
+                count += bucket_count
+        return total / count, window_end
+
+
+class MovingAverageEngine:
+    """Maintains hopping-window averages per (device, dataitem) from incoming samples"""
+
+    def __init__(self, windows: Dict[str, Tuple[int, int]]):
+        """
+        Args:
+            windows: Window (size, advance) in seconds by dataitem ID
+        """
+        self.windows = {
+            dataitem_id: (int(size * 1000), int(advance * 1000))
+            for dataitem_id, (size, advance) in windows.items()
+        }
+        self._series: Dict[Tuple[str, str], HoppingWindowAverage] = {}
+
+    def add(self, device_uuid: str, dataitem_id: str, value, timestamp: str) -> dict:
+        """Add a sample and return its {'value', 'timestamp'} average, or {} if not averaged"""
+        window = self.windows.get(dataitem_id)
+        if window is None:
+            return {}
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return {}
+
+        series = self._series.get((device_uuid, dataitem_id))
+        if series is None:
+            series = self._series[(device_uuid, dataitem_id)] = HoppingWindowAverage(*window)
+
+        result = series.add(stream_timestamp_to_epoch_ms(timestamp), value)
+        if result is None:
+            return {}
+        average, window_end = result
+        window_end_local = datetime.fromtimestamp(window_end / 1000, STREAM_TIMEZONE).replace(tzinfo=None)
+        return {
+            'value': average,
+            'timestamp': format_stream_timestamp(window_end_local)
+        }
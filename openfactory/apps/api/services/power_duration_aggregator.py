@@ -0,0 +1,69 @@
+from typing import Dict, Iterable, Tuple
+
+from services.timestamps import stream_timestamp_to_epoch_ms
+
+
+class PowerDurationAggregator:
+    """
+    Keeps the IVAC power state totals in memory.
+
+    Mirrors usage_duration.sql: the latest (value, timestamp) of each tool is updated on
+    every event, and when a tool's value changes, the time elapsed since its previous
+    event is added to the '<ID>_<state just ended>' total, in whole seconds.
+    """
+
+    def __init__(self, device_uuid: str = 'IVAC',
+                 dataitems: Iterable[str] = ('A1ToolPlus', 'A2ToolPlus', 'A3ToolPlus')):
+        self.device_uuid = device_uuid
+        self.dataitems = frozenset(dataitems)
+        self.latest_state: Dict[str, Tuple[str, int]] = {}
+        self.totals: Dict[str, int] = {}
+        self.seeded = False
+
+    async def seed(self, ksql_client):
+        """Load the current totals and latest states from the ksqlDB tables"""
+        df = await ksql_client.query("SELECT IVAC_POWER_KEY, TOTAL_DURATION_SEC FROM IVAC_POWER_STATE_TOTALS;")
+        totals = {}
+        if 'IVAC_POWER_KEY' in df.columns and 'TOTAL_DURATION_SEC' in df.columns:
+            totals = dict(zip(df.IVAC_POWER_KEY.tolist(), (int(v) for v in df.TOTAL_DURATION_SEC.tolist())))
+
+        df = await ksql_client.query("SELECT KEY, LAST_VALUE, LAST_TS FROM LATEST_IVAC_POWER_STATE;")
+        latest_state = {}
+        if 'KEY' in df.columns and 'LAST_VALUE' in df.columns and 'LAST_TS' in df.columns:
+            latest_state = {
+                key: (value, int(ts))
+                for key, value, ts in zip(df.KEY.tolist(), df.LAST_VALUE.tolist(), df.LAST_TS.tolist())
+            }
+
+        # Events received while seeding add to the seeded totals, and their states replace
+        # the seeded ones they are more recent than
+        for key, increment in self.totals.items():
+            totals[key] = totals.get(key, 0) + increment
+        for dataitem_id, (value, ts) in self.latest_state.items():
+            seeded = latest_state.get(dataitem_id)
+            if seeded is None or ts > seeded[1]:
+                latest_state[dataitem_id] = (value, ts)
+        self.totals = totals
+        self.latest_state = latest_state
+        self.seeded = True
+
+    def update(self, dataitem_id: str, value: str, timestamp: str) -> bool:
+        """Apply a power event, returns False if the dataitem is not tracked"""
+        if dataitem_id not in self.dataitems:
+            return False
+
+        ts = stream_timestamp_to_epoch_ms(timestamp)
+        last = self.latest_state.get(dataitem_id)
+        if last is not None and value != last[0]:
+            key = f'{dataitem_id}_{last[0]}'
+            self.totals[key] = self.totals.get(key, 0) + (ts - last[1]) // 1000
+        self.latest_state[dataitem_id] = (value, ts)
+        return True
+
+    def get_durations(self, prefix: str) -> Dict[str, int]:
+        """Get the totals by state for the power keys starting with prefix"""
+        return {
+            key.rsplit('_', 1)[1]: total
+            for key, total in self.totals.items()
+            if key.startswith(prefix)
+        }
@@ -1,13 +1,28 @@
 from exceptions import StreamCreationException
+from metrics import KSQLDB_QUERY_LATENCY
+from services.async_ksqldb import AsyncKSQLDBClient
 
 class StreamService:
     """Handles Kafka stream operations"""
-    
-    def __init__(self, ksqlClient):
+
+    PER_DEVICE = "per_device"
+    SHARED = "shared"
+
+    SHARED_STREAM_NAME = "devices_stream_shared"
+
+    def __init__(self, ksqlClient: AsyncKSQLDBClient, stream_mode: str = PER_DEVICE,
+                 shared_topic: str = "ofa_api_devices", shared_partitions: int = 6):
         self.ksqlClient = ksqlClient
-    
-    def create_device_stream(self, device_uuid: str) -> str:
+        self.stream_mode = stream_mode
+        self.shared_topic = shared_topic
+        self.shared_partitions = shared_partitions
+        self._shared_stream_created = False
+
+    async def create_device_stream(self, device_uuid: str) -> str:
         """Create a Kafka stream for device monitoring"""
+        if self.stream_mode == self.SHARED:
+            return await self.create_shared_stream()
+
         topic_name = f'{device_uuid}_monitoring'
         try:
             query = (
@@ -19,18 +34,47 @@ class StreamService:
                 f"AND TYPE IN ('Events', 'Condition', 'Samples') AND VALUE != 'UNAVAILABLE' "
                 f"EMIT CHANGES;"
             )
-            self.ksqlClient.statement_query(query)
+            with KSQLDB_QUERY_LATENCY.labels('create_device_stream').time():
+                await self.ksqlClient.statement_query(query)
             return topic_name
         except Exception as e:
             print(f"Failed to create stream for {device_uuid}: {e}")
             raise StreamCreationException(f"Failed to create stream for device {device_uuid}: {e}")
-    
-    def drop_device_stream(self, device_uuid: str) -> None:
+
+    async def create_shared_stream(self) -> str:
+        """Create the stream carrying updates of all devices, keyed by ASSET_UUID"""
+        if self._shared_stream_created:
+            return self.shared_topic
+
+        try:
+            query = (
+                f"CREATE STREAM IF NOT EXISTS {self.SHARED_STREAM_NAME} "
+                f"WITH (KAFKA_TOPIC='{self.shared_topic}', PARTITIONS={self.shared_partitions}) AS "
+                f"SELECT ASSET_UUID AS KEY, ID, VALUE, "
+                f"TIMESTAMPTOSTRING(ROWTIME, 'yyyy-MM-dd''T''HH:mm:ss[.nnnnnnn]', 'Canada/Eastern') AS TIMESTAMP "
+                f"FROM ASSETS_STREAM WHERE TYPE IN ('Events', 'Condition', 'Samples') AND VALUE != 'UNAVAILABLE' "
+                f"EMIT CHANGES;"
+            )
+            with KSQLDB_QUERY_LATENCY.labels('create_shared_stream').time():
+                await self.ksqlClient.statement_query(query)
+            self._shared_stream_created = True
+            print(f"Shared device stream ready on topic {self.shared_topic}")
+            return self.shared_topic
+        except Exception as e:
+            print(f"Failed to create shared device stream: {e}")
+            raise StreamCreationException(f"Failed to create shared device stream: {e}")
+
+    async def drop_device_stream(self, device_uuid: str) -> None:
         """Drop a device stream"""
+        if self.stream_mode == self.SHARED:
+            print(f"Device {device_uuid} uses the shared stream, nothing to drop")
+            return
+
         try:
             query = f"DROP STREAM IF EXISTS device_stream_{device_uuid};"
-            self.ksqlClient.statement_query(query)
+            with KSQLDB_QUERY_LATENCY.labels('drop_device_stream').time():
+                await self.ksqlClient.statement_query(query)
             print(f"Dropped stream for device {device_uuid}")
         except Exception as e:
             print(f"Failed to drop stream for {device_uuid}: {e}")
-            raise StreamCreationException(f"Failed to drop stream for device {device_uuid}: {e}")
\ No newline at end of file
+            raise StreamCreationException(f"Failed to drop stream for device {device_uuid}: {e}")
@@ -0,0 +1,28 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+# Timezone used by TIMESTAMPTOSTRING in the device streams
+STREAM_TIMEZONE = ZoneInfo('Canada/Eastern')
+
+
+def parse_stream_timestamp(timestamp: str) -> datetime:
+    """
+    Parse a 'yyyy-MM-ddTHH:mm:ss[.nnnnnnn]' stream timestamp into a naive local datetime.
+    nnnnnnn is the nano-of-second, padded to at least 7 digits (829 ms is .829000000)
+    """
+    seconds, _, nanos = timestamp.partition('.')
+    parsed = datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+    if nanos:
+        parsed = parsed.replace(microsecond=int(nanos) // 1000)
+    return parsed
+
+
+def stream_timestamp_to_epoch_ms(timestamp: str) -> int:
+    """Convert a stream timestamp to epoch milliseconds, like ksqlDB's ROWTIME"""
+    parsed = parse_stream_timestamp(timestamp).replace(tzinfo=STREAM_TIMEZONE)
+    return int(parsed.timestamp() * 1000)
+
+
+def format_stream_timestamp(value: datetime) -> str:
+    """Format a naive local datetime the way TIMESTAMPTOSTRING does in the device streams"""
+    return f"{value.strftime('%Y-%m-%dT%H:%M:%S')}.{value.microsecond * 1000:07d}"
@@ -1,101 +1,275 @@
 import threading
-import json
-from typing import Callable, Optional, Dict, Any
-from kafka import KafkaConsumer
+import time
+from typing import Callable, Optional, Dict, Iterable, List, Tuple
+from kafka import KafkaConsumer, TopicPartition
+
+import json_codec
+from metrics import CONSUMER_LAG, KAFKA_RECORD_AGE
 
 
 class TopicSubscriber:
-    
-    
-    def __init__(self):
-        self._active_consumers: Dict[str, KafkaConsumer] = {}
-        self._consumer_threads: Dict[str, threading.Thread] = {}
-        self._stop_flags: Dict[str, threading.Event] = {}
-
-    def subscribe_to_kafka_topic(self, 
-                            topic: str, 
-                            kafka_group_id: str,
-                            on_message: Callable[[Dict[str, Any]], None],
-                            bootstrap_servers: str = "broker:29092",
-                            message_filter: Optional[Callable[[Dict[str, Any]], bool]] = None) -> None:
+    """
+    Multiplexes all topic subscriptions of the API over a single Kafka consumer.
+
+    Subscribing registers a callback for a topic (and optionally a single message key)
+    and the consumer thread dispatches each record to the matching callback. A batch
+    callback is called once per poll with all its records instead. Values are decoded
+    from JSON in the consumer thread, raw callbacks also get the bytes as received.
+    """
+
+    # Seconds between two updates of the consumer lag metric
+    LAG_INTERVAL = 5
+    # Seconds waited after a consumer error, doubled on each consecutive error up to the max
+    ERROR_BACKOFF = 0.5
+    MAX_ERROR_BACKOFF = 30
+
+    def __init__(self, bootstrap_servers: str = "broker:29092",
+                 kafka_group_id: str = "ofa_api_stream_group",
+                 poll_timeout_ms: int = 100,
+                 max_records: int = 500,
+                 linger_ms: int = 0):
+        self.bootstrap_servers = bootstrap_servers
+        self.kafka_group_id = kafka_group_id
+        self.poll_timeout_ms = poll_timeout_ms
+        # Records returned by one poll, and time spent polling again to fill a batch
+        # once the first records arrived
+        self.max_records = max_records
+        self.linger_ms = linger_ms
+
+        # topic -> {message key (None for any key) -> (callback, batch, raw)}, replaced on write
+        # so the consumer thread can read it without locking
+        self._handlers: Dict[str, Dict[Optional[str], Tuple[Callable, bool, bool]]] = {}
+        # topic -> partitions consumed, for topics shared with other API workers
+        self._assignments: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+        self._subscription_changed = threading.Event()
+        self._stop_flag = threading.Event()
+        self._consumer_thread: Optional[threading.Thread] = None
+
+    def subscribe_to_kafka_topic(self,
+                                 topic: str,
+                                 on_message: Callable,
+                                 key: Optional[str] = None,
+                                 batch: bool = False,
+                                 raw: bool = False) -> None:
         """
-        Subscribe to a Kafka topic with a callback function
-        
+        Register a callback for messages of a Kafka topic
+
         Args:
             topic: Kafka topic name
-            kafka_group_id: Consumer group ID
-            on_message: Callback function for processing messages
-            bootstrap_servers: Kafka bootstrap servers
-            message_filter: Optional filter function
+            on_message: Callback function for processing messages, called with (key, value),
+                        or with a list of (key, value) if batch
+            key: Only dispatch messages with this key (all keys if None)
+            batch: Call on_message once per poll with all its records
+            raw: Also pass the value bytes as received, records being (key, value, raw value)
         """
-        if topic in self._active_consumers:
-            print(f"Already subscribed to topic: {topic}")
+        with self._lock:
+            handlers = self._handlers.get(topic, {})
+            if key in handlers:
+                print(f"Already subscribed to topic: {topic} (key: {key})")
+                return
+
+            new_topic = topic not in self._handlers
+            self._handlers = {**self._handlers, topic: {**handlers, key: (on_message, batch, raw)}}
+            if new_topic:
+                self._subscription_changed.set()
+
+            self._ensure_consumer_thread()
+
+    def assign_partitions(self, topic: str, partitions: Iterable[int]) -> None:
+        """
+        Only consume the given partitions of a topic. Once any topic is assigned, partitions
+        are assigned manually instead of through the consumer group.
+        """
+        with self._lock:
+            self._assignments = {**self._assignments, topic: sorted(partitions)}
+            self._subscription_changed.set()
+
+    def _topic_partitions(self, consumer: KafkaConsumer, topics: List[str]) -> Optional[List[TopicPartition]]:
+        """Partitions to assign for the subscribed topics, or None while a topic has no metadata yet"""
+        topic_partitions = []
+        for topic in topics:
+            partitions = self._assignments.get(topic)
+            if partitions is None:
+                partitions = consumer.partitions_for_topic(topic)
+                if partitions is None:
+                    return None
+            topic_partitions.extend(TopicPartition(topic, partition) for partition in partitions)
+        return topic_partitions
+
+    def _ensure_consumer_thread(self) -> None:
+        """Start the shared consumer thread if it is not running"""
+        if self._consumer_thread and self._consumer_thread.is_alive():
             return
-        
-        self._stop_flags[topic] = threading.Event()
-        
-        consumer_thread = threading.Thread(
-            target=self._consume_kafka_topic,
-            args=(topic, kafka_group_id, on_message, bootstrap_servers, message_filter),
-            daemon=True
-        )
-        consumer_thread.start()
-        self._consumer_threads[topic] = consumer_thread
-
-    def _consume_kafka_topic(self, 
-                        topic: str, 
-                        kafka_group_id: str,
-                        on_message: Callable[[str, Dict[str, Any]], None],
-                        bootstrap_servers: str,
-                        message_filter: Optional[Callable[[Dict[str, Any]], bool]] = None) -> None:
-        """Internal function to consume messages from a topic"""
+        self._stop_flag.clear()
+        self._subscription_changed.set()
+        self._consumer_thread = threading.Thread(target=self._consume_kafka_topics, daemon=True)
+        self._consumer_thread.start()
+
+    def _consume_kafka_topics(self) -> None:
+        """Internal function consuming all subscribed topics and dispatching messages"""
+        consumer = None
+        backoff = self.ERROR_BACKOFF
+        next_lag_update = 0
+        lag_topics = set()
         try:
-            consumer = KafkaConsumer(
-                topic,
-                bootstrap_servers=bootstrap_servers,
-                group_id=kafka_group_id,
-                value_deserializer=lambda m: json.loads(m.decode('utf-8')) if m else None,
-                key_deserializer=lambda m: m.decode('utf-8') if m else None,
-                auto_offset_reset='latest',
-                enable_auto_commit=True
-            )
-            
-            self._active_consumers[topic] = consumer
-
-            for message in consumer:
-                if self._stop_flags[topic].is_set():
-                    break
-                if message.value is not None:
-                    if message_filter and not message_filter(message.key):
+            while not self._stop_flag.is_set():
+                try:
+                    if consumer is None:
+                        consumer = KafkaConsumer(
+                            bootstrap_servers=self.bootstrap_servers,
+                            group_id=self.kafka_group_id,
+                            key_deserializer=lambda m: m.decode('utf-8') if m else None,
+                            auto_offset_reset='latest',
+                            enable_auto_commit=True,
+                            max_poll_records=self.max_records
+                        )
+                        self._subscription_changed.set()
+
+                    if self._subscription_changed.is_set():
+                        self._subscription_changed.clear()
+                        self._apply_subscription(consumer)
+
+                    if not consumer.subscription() and not consumer.assignment():
+                        self._stop_flag.wait(self.poll_timeout_ms / 1000)
                         continue
-                    
-                    on_message(message.key, message.value)
-                    
-        except Exception as e:
-            print(f"Error in topic consumer for {topic}: {e}")
+
+                    self._dispatch(self._poll(consumer))
+
+                    if time.monotonic() >= next_lag_update:
+                        next_lag_update = time.monotonic() + self.LAG_INTERVAL
+                        lag_topics = self._update_consumer_lag(consumer, lag_topics)
+                    backoff = self.ERROR_BACKOFF
+
+                except Exception as e:
+                    print(f"Error in Kafka consumer, retrying in {backoff}s: {e}")
+                    # Subscribe again once recovered, in case the error left it half applied
+                    self._subscription_changed.set()
+                    self._stop_flag.wait(backoff)
+                    backoff = min(backoff * 2, self.MAX_ERROR_BACKOFF)
         finally:
-            if topic in self._active_consumers:
-                self._active_consumers[topic].close()
-                del self._active_consumers[topic]
+            if consumer:
+                consumer.close()
+
+    def _apply_subscription(self, consumer: KafkaConsumer) -> None:
+        """Subscribe or assign the consumer to the topics currently having callbacks"""
+        topics = list(self._handlers.keys())
+        if self._assignments:
+            topic_partitions = self._topic_partitions(consumer, topics)
+            if topic_partitions is None:
+                # Retry once the topic metadata is available
+                self._subscription_changed.set()
+            else:
+                if consumer.subscription():
+                    consumer.unsubscribe()
+                consumer.assign(topic_partitions)
+        elif topics:
+            consumer.subscribe(topics=topics)
+        else:
+            consumer.unsubscribe()
+
+    def _poll(self, consumer: KafkaConsumer) -> Dict[TopicPartition, list]:
+        """Poll up to max_records records, lingering up to linger_ms for more once some arrived"""
+        records = consumer.poll(timeout_ms=self.poll_timeout_ms, max_records=self.max_records)
+        if not self.linger_ms or not records:
+            return records
+
+        count = sum(len(messages) for messages in records.values())
+        deadline = time.monotonic() + self.linger_ms / 1000
+        while count < self.max_records:
+            remaining_ms = int((deadline - time.monotonic()) * 1000)
+            if remaining_ms <= 0:
+                break
+            more = consumer.poll(timeout_ms=remaining_ms, max_records=self.max_records - count)
+            for topic_partition, messages in more.items():
+                records.setdefault(topic_partition, []).extend(messages)
+                count += len(messages)
+        return records
+
+    def _dispatch(self, records: Dict[TopicPartition, list]) -> None:
+        """Hand polled records to their callbacks, batch callbacks getting all theirs in one call"""
+        now = time.time()
+        batches: Dict[Callable, List[tuple]] = {}
+        for topic_partition, messages in records.items():
+            handlers = self._handlers.get(topic_partition.topic)
+            if not handlers:
+                continue
+            any_key = handlers.get(None)
+            for message in messages:
+                if not message.value:
+                    continue
+                KAFKA_RECORD_AGE.observe(now - message.timestamp / 1000)
+                handler = handlers.get(message.key) or any_key
+                if handler is None:
+                    continue
+                try:
+                    value = json_codec.loads(message.value)
+                except json_codec.JSONDecodeError as e:
+                    print(f"Invalid JSON record on {topic_partition.topic}: {e}")
+                    continue
+                on_message, batch, raw = handler
+                record = (message.key, value, message.value) if raw else (message.key, value)
+                if batch:
+                    batches.setdefault(on_message, []).append(record)
+                    continue
+                try:
+                    on_message(*record)
+                except Exception as e:
+                    print(f"Error in callback for {topic_partition.topic}: {e}")
+
+        for on_batch, batch in batches.items():
+            try:
+                on_batch(batch)
+            except Exception as e:
+                print(f"Error in batch callback: {e}")
+
+    def _update_consumer_lag(self, consumer: KafkaConsumer, previous_topics: set) -> set:
+        """Set the lag of each consumed topic from the last known highwater offsets"""
+        lags: Dict[str, int] = {}
+        for topic_partition in consumer.assignment():
+            highwater = consumer.highwater(topic_partition)
+            position = consumer.position(topic_partition)
+            if highwater is None or position is None:
+                continue
+            lags[topic_partition.topic] = lags.get(topic_partition.topic, 0) + max(highwater - position, 0)
+
+        for topic, lag in lags.items():
+            CONSUMER_LAG.labels(topic).set(lag)
+        for topic in previous_topics - lags.keys():
+            CONSUMER_LAG.remove(topic)
+        return set(lags)
+
+    def unsubscribe_from_kafka_topic(self, topic: str, key: Optional[str] = None) -> None:
+        """Remove the callback registered for a topic and key"""
+        with self._lock:
+            handlers = self._handlers.get(topic)
+            if not handlers or key not in handlers:
+                return
+            handlers = {k: v for k, v in handlers.items() if k != key}
+            if handlers:
+                self._handlers = {**self._handlers, topic: handlers}
+            else:
+                self._handlers = {t: h for t, h in self._handlers.items() if t != topic}
+                self._subscription_changed.set()
 
     def stop_kafka_topic_subscription(self, topic: str) -> None:
         """Stop subscription to a specific topic"""
-        if topic in self._stop_flags:
-            self._stop_flags[topic].set()
-            
-        if topic in self._consumer_threads:
-            self._consumer_threads[topic].join(timeout=5)
-            del self._consumer_threads[topic]
-            
-        if topic in self._stop_flags:
-            del self._stop_flags[topic]
+        with self._lock:
+            if topic in self._handlers:
+                self._handlers = {t: h for t, h in self._handlers.items() if t != topic}
+                self._subscription_changed.set()
 
     def stop_all_kafka_subscriptions(self) -> None:
-        """Stop all topic subscriptions"""
-        topics_to_stop = list(self._stop_flags.keys())
-        for topic in topics_to_stop:
-            self.stop_kafka_topic_subscription(topic)
+        """Stop all topic subscriptions and the consumer thread"""
+        with self._lock:
+            self._handlers = {}
+            self._stop_flag.set()
+            consumer_thread = self._consumer_thread
+            self._consumer_thread = None
+
+        if consumer_thread:
+            consumer_thread.join(timeout=5)
 
     def get_active_kafka_subscriptions(self) -> list:
         """Get list of currently active subscriptions"""
-        return list(self._active_consumers.keys())
\ No newline at end of file
+        return list(self._handlers.keys())